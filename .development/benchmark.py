@@ -0,0 +1,483 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./.development/benchmark.py
+
+Times each stage of the pipeline over synthetic WildWeb (HTML) and WildWeb-E
+(JSON) feeds of 10 to 10,000 incidents, with resource churn between polls.
+Runs against a throwaway DB in a temp directory, never the real one. Results
+are saved as JSON so runs from different commits can be compared:
+
+    python3 .development/benchmark.py [--sizes 10,100,1000] [--repeat 3]
+    python3 .development/benchmark.py --compare OLD.json NEW.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+results_path = os.path.join(repo_path, ".development", "benchmarks")
+
+TYPES = (
+    "Wildfire",
+    "Smoke Check",
+    "Vehicle Fire",
+    "Medical Aid",
+    "Miscellaneous",
+    "Law Enforcement",
+)
+RESOURCE_PREFIXES = ("E", "ENG", "CRW", "DIV", "MM", "HT", "AA", "WT", "DZ")
+
+# ------------------------------------------------------------------------------
+
+
+def synthetic_incidents(count, rng):
+    """
+    Returns `count` format-neutral incident dicts. About 5% are large, with
+    50-150 resources, like a multi-day fire
+    """
+    incidents = []
+
+    for num in range(count):
+        if rng.random() < 0.05:
+            resource_count = rng.randint(50, 150)
+        else:
+            resource_count = rng.randint(0, 8)
+
+        incidents.append(
+            {
+                "num": 1000 + num,
+                "date": datetime.datetime(2025, 2, 1)
+                + datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 30)),
+                "name": "SYNTHETIC " + str(num),
+                "type": rng.choice(TYPES),
+                "location": "MILE MARKER " + str(rng.randint(1, 99)),
+                "comment": rng.choice(("", "Ground units en route", "Contained")),
+                "acres": rng.choice(("", "0.1", "5", "250")),
+                "resources": random_resources(rng, resource_count),
+                "lat": round(rng.uniform(34.1, 34.6), 6) if rng.random() < 0.8 else None,
+                "lon": round(rng.uniform(117.6, 118.6), 6),
+            }
+        )
+
+    return incidents
+
+
+def random_resources(rng, count):
+    """
+    Returns a sorted list of unique resource IDs, EG: ENG-19
+    """
+    return sorted(
+        {rng.choice(RESOURCE_PREFIXES) + "-" + str(rng.randint(1, 999)) for _ in range(count)}
+    )
+
+
+def churn(incidents, rng, fraction=0.05):
+    """
+    Returns the next poll's incidents: `fraction` of them have resources added
+    and removed (some also renamed or moved), a few have left the feed and a
+    few new ones have appeared
+    """
+    next_incidents = []
+
+    for inci in incidents:
+        roll = rng.random()
+
+        if roll < fraction / 5:  # Left the feed
+            continue
+
+        if roll < fraction:
+            inci = dict(inci)
+            kept = [res for res in inci["resources"] if rng.random() > 0.2]
+            inci["resources"] = sorted(set(kept + random_resources(rng, rng.randint(1, 10))))
+
+            if rng.random() < 0.3:
+                inci["name"] = inci["name"] + " FIRE"
+            if rng.random() < 0.2 and inci["lat"] is not None:
+                inci["lat"] = round(inci["lat"] + 0.01, 6)
+
+        next_incidents.append(inci)
+
+    new_count = max(1, int(len(incidents) * fraction / 5))
+    for inci in synthetic_incidents(new_count, rng):
+        inci["num"] += len(incidents) + rng.randint(0, 10 ** 6)
+        next_incidents.append(inci)
+
+    return next_incidents
+
+
+# ------------------------------------------------------------------------------
+
+
+def ddm(decimal_degrees, negative=False):
+    """
+    Formats a coordinate as WildWeb's degrees + decimal minutes, EG: 34 20.586
+    """
+    degrees = int(decimal_degrees)
+    minutes = (decimal_degrees - degrees) * 60
+    return ("-" if negative else "") + str(degrees) + " " + ("%.3f" % minutes)
+
+
+def render_wildweb(incidents):
+    """
+    Renders incidents as a WildWeb "recent incidents" HTML table
+    """
+    cell = '<TD align="CENTER" bgcolor="#FFFFCC"><font size="2">{}</font></TD>\n'
+    rows = [
+        "<html><body><TABLE border=4 cellPadding=0 cellSpacing=1>\n",
+        '<TR><TD colspan="10">Recent Incidents</TD></TR>\n',
+        "<TR>"
+        + "".join(
+            "<TD>" + header + "</TD>"
+            for header in (
+                "Date", "Inc #", "Name", "Type", "Location",
+                "WebComment", "Resources", "IC", "Acres", "Lat/Lon",
+            )
+        )
+        + "</TR>\n",
+    ]
+
+    for inci in incidents:
+        lat_lon = ""
+        if inci["lat"] is not None:
+            lat_lon = ddm(inci["lat"]) + ", " + ddm(inci["lon"], True)
+
+        rows.append(
+            "<TR>\n"
+            + cell.format(inci["date"].strftime("%m/%d/%Y %H:%M"))
+            + cell.format("ANF-" + str(inci["num"]) + "<br>")
+            + cell.format(inci["name"])
+            + cell.format(inci["type"])
+            + cell.format(inci["location"])
+            + cell.format(inci["comment"] or ".")
+            + cell.format(" ".join(inci["resources"]) or ".")
+            + cell.format(".")
+            + cell.format(inci["acres"] or ".")
+            + cell.format(lat_lon)
+            + "</TR>\n"
+        )
+
+    rows.append("</TABLE></body></html>\n")
+    return "".join(rows)
+
+
+def render_wildweb_e(incidents):
+    """
+    Renders incidents as a WildWeb-E JSON payload
+    """
+    data = []
+
+    for inci in incidents:
+        data.append(
+            {
+                "date": inci["date"].strftime("%Y-%m-%dT%H:%M:%S"),
+                "fiscal_data": json.dumps(
+                    {"inc_num": str(inci["num"]), "wfdssunit": "CAANF"}
+                ),
+                "inc_num": str(inci["num"]),
+                "name": inci["name"],
+                "type": inci["type"],
+                "webComment": inci["comment"] or None,
+                "acres": inci["acres"] or None,
+                "resources": inci["resources"] or [None],
+                "latitude": None if inci["lat"] is None else str(inci["lat"]),
+                "longitude": None if inci["lat"] is None else str(inci["lon"]),
+            }
+        )
+
+    return json.dumps([{"data": data, "retrieved": "2025-02-02T20:00:00"}])
+
+
+FORMATS = {"wildweb": render_wildweb, "wildweb-e": render_wildweb_e}
+
+# ------------------------------------------------------------------------------
+
+
+def load_firebot(work_path, env=None):
+    """
+    Imports firebot.py against a throwaway .env and DB in work_path. `env` adds
+    or overrides .env keys
+    """
+    env = {
+        "NF_IDENTIFIER": "ANF",
+        "URL_SHORT": "bench.example",
+        "TELEGRAM_CHAT_ID": "@benchmark",
+        **(env or {}),
+    }
+
+    with open(os.path.join(work_path, ".env"), "w", encoding="utf-8") as env_file:
+        env_file.write("".join(key + "=" + str(value) + "\n" for key, value in env.items()))
+
+    os.chdir(work_path)
+    sys.path.insert(0, repo_path)
+
+    import store  # pylint: disable=import-outside-toplevel
+
+    store.DB_PATH = os.path.join(work_path, "firebot.sqlite3")
+
+    import firebot  # pylint: disable=import-outside-toplevel
+
+    firebot.setup(["firebot.py"])  # No options: normal logging, real send paths
+
+    return firebot
+
+
+def use_fresh_db(firebot, work_path, label):
+    """
+    Points firebot at a new, empty DB
+    """
+    import store  # pylint: disable=import-outside-toplevel
+
+    firebot.store = store.Store(os.path.join(work_path, label + ".sqlite3"))
+    firebot.short_urls = store.ShortUrls(firebot.store)
+    firebot.contacts = store.Contacts(firebot.store)
+
+
+class Timer:
+    """
+    Collects the duration of each named stage
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, func, *args):
+        """
+        Runs func(*args), recording how long it took. Returns its result
+        """
+        started = time.perf_counter()
+        result = func(*args)
+        self.stages[stage] = time.perf_counter() - started
+        return result
+
+
+def run_case(firebot, work_path, fmt, size, seed, label):
+    """
+    Runs every stage once, for one format and feed size, on a fresh DB.
+    Returns {stage: seconds}
+    """
+    from incident import ResourceChange, diff_incidents  # pylint: disable=import-outside-toplevel
+
+    rng = random.Random(seed)
+    first = synthetic_incidents(size, rng)
+    second = churn(first, rng)
+    first_page = FORMATS[fmt](first)
+    second_page = FORMATS[fmt](second)
+
+    use_fresh_db(firebot, work_path, label)
+    this_forest = firebot.build_forest("ANF", fmt == "wildweb-e" and "caancc")
+    firebot.use_forest(this_forest)
+    timer = Timer()
+
+    # Parsing and classification
+    inci_list, _ = timer.time("parse", firebot.process_wildcad, first_page)
+    next_list, _ = firebot.process_wildcad(second_page)
+    timer.time("is_fire", lambda: [firebot.is_fire(inci) for inci in inci_list])
+
+    # DB writes, then reads
+    def write_all():
+        incidents = firebot.store.incident_state("ANF")
+        for inci in inci_list:
+            incidents.save(inci)
+        incidents.commit()
+
+    timer.time("db_write", write_all)
+    incidents = timer.time("db_read", firebot.store.incident_state, "ANF")
+
+    # Steady state: only the churned records are decoded
+    timer.time(
+        "parse_fingerprinted",
+        firebot.process_wildcad,
+        second_page,
+        incidents.fingerprints(),
+    )
+
+    # Diffing
+    pairs = [
+        (inci, incidents.get(inci.id)) for inci in next_list if incidents.get(inci.id)
+    ]
+    diffs = timer.time(
+        "diff", lambda: [(inci, old, diff_incidents(inci, old)) for inci, old in pairs]
+    )
+    diffs = [diff for diff in diffs if diff[2]]
+    timer.time(
+        "granular_diff_list",
+        lambda: [
+            firebot.granular_diff_list(change)
+            for _, _, changes in diffs
+            for change in changes
+            if isinstance(change, ResourceChange)
+        ],
+    )
+
+    # URL shortening: first allocation, then the in-memory hit
+    urls = []
+    for inci in inci_list:
+        geo = firebot.incident_geo(inci)
+        if geo:
+            urls.extend(geo[link] for link in firebot.MAP_LINKS)
+
+    timer.time("shorten_url_new", lambda: [firebot.shorten_url(url) for url in urls])
+    timer.time("shorten_url_known", lambda: [firebot.shorten_url(url) for url in urls])
+
+    # Rendering every body once (links already shortened)
+    def render():
+        for inci in inci_list:
+            firebot.generate_notif_body(inci)
+            firebot.generate_plain_initial_notif_body(inci)
+        for inci, old, changes in diffs:
+            firebot.generate_rich_diff_body(inci, old, changes)
+            firebot.generate_plain_diff_body(inci, changes)
+
+    timer.time("render", render)
+
+    # End to end, as a poll would run it: first sight, then a churned poll
+    use_fresh_db(firebot, work_path, label + "-pipeline")
+    this_forest["ignored_fingerprints"] = {}
+    timer.time("pipeline_first_poll", firebot.process_forest, first_page)
+    timer.time("pipeline_next_poll", firebot.process_forest, second_page)
+
+    return timer.stages
+
+
+# ------------------------------------------------------------------------------
+
+
+def git_commit():
+    """
+    Returns the current commit's short hash, with "+" if the tree is dirty
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=repo_path, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=repo_path, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    return commit + ("+" if dirty else "")
+
+
+def run(sizes, repeat, output):
+    """
+    Benchmarks every format and size, keeping each stage's best time across
+    `repeat` runs. Prints a table and saves the results as JSON
+    """
+    work_path = tempfile.mkdtemp(prefix="firebot-bench-")
+    firebot = load_firebot(work_path)
+    results = []
+
+    print("%-10s %7s  %-22s %12s %12s" % ("format", "size", "stage", "ms", "us/incident"))
+
+    for fmt in FORMATS:
+        for size in sizes:
+            best = {}
+
+            for attempt in range(repeat):
+                stages = run_case(
+                    firebot, work_path, fmt, size, size, fmt + "-" + str(size) + "-" + str(attempt)
+                )
+                for stage, seconds in stages.items():
+                    best[stage] = min(seconds, best.get(stage, seconds))
+
+            for stage, seconds in best.items():
+                results.append(
+                    {"format": fmt, "incidents": size, "stage": stage, "seconds": seconds}
+                )
+                print(
+                    "%-10s %7d  %-22s %12.3f %12.2f"
+                    % (fmt, size, stage, seconds * 1000, seconds * 10 ** 6 / size)
+                )
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+    if output is None:
+        os.makedirs(results_path, exist_ok=True)
+        output = os.path.join(
+            results_path,
+            datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + "-" + commit + ".json",
+        )
+
+    with open(output, "w", encoding="utf-8") as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print("Saved " + output)
+
+
+def compare(old_path, new_path, threshold):
+    """
+    Prints each stage's old and new time. Returns 1 if any stage got slower by
+    more than `threshold` (EG: 0.2 = 20%), else 0
+    """
+    with open(old_path, encoding="utf-8") as old_file:
+        old = json.load(old_file)
+    with open(new_path, encoding="utf-8") as new_file:
+        new = json.load(new_file)
+
+    old_times = {
+        (row["format"], row["incidents"], row["stage"]): row["seconds"]
+        for row in old["results"]
+    }
+    regressions = 0
+
+    print("Comparing " + old["commit"] + " -> " + new["commit"])
+    print("%-10s %7s  %-22s %10s %10s %8s" % ("format", "size", "stage", "old ms", "new ms", "change"))
+
+    for row in new["results"]:
+        key = (row["format"], row["incidents"], row["stage"])
+        if key not in old_times:
+            continue
+
+        change = row["seconds"] / old_times[key] - 1 if old_times[key] else 0
+        flag = ""
+        if change > threshold:
+            regressions += 1
+            flag = "  SLOWER"
+
+        print(
+            "%-10s %7d  %-22s %10.3f %10.3f %+7.0f%%%s"
+            % (
+                key[0], key[1], key[2],
+                old_times[key] * 1000, row["seconds"] * 1000, change * 100, flag,
+            )
+        )
+
+    return 1 if regressions else 0
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark FireBot's pipeline stages")
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="feed sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per size; best is kept")
+    parser.add_argument("--output", help="results file (default: .development/benchmarks/)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two results")
+    parser.add_argument("--threshold", type=float, default=0.2, help="regression threshold")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(args.compare[0], args.compare[1], args.threshold))
+
+    run([int(size) for size in args.sizes.split(",")], args.repeat, args.output)
@@ -0,0 +1,128 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./.development/importtime.py
+
+Import-time budget check for firebot.py, which cron starts once a minute.
+Imports it in a fresh interpreter under `python -X importtime`, prints the
+heaviest modules, and exits non-zero if the import took longer than the budget
+or pulled in a backend that should only be loaded when it is used:
+
+    python3 .development/importtime.py [--budget 100] [--repeat 5] [--top 15]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+repo_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Imported by firebot.py where they are first used, never at import time
+LAZY_MODULES = ("aiohttp", "requests", "twilio", "lxml", "json_log_formatter")
+
+# ------------------------------------------------------------------------------
+
+
+def measure(module):
+    """
+    Imports `module` in a fresh interpreter. Returns [(name, self µs,
+    cumulative µs, depth)] in the order -X importtime reports them
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=repo_path,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+
+    if process.returncode != 0:  # EG: work done at import time failed
+        print(process.stderr.splitlines()[-1], file=sys.stderr)
+        sys.exit("import " + module + " failed")
+
+    rows = []
+
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+
+    return rows
+
+
+def total_ms(rows, module):
+    """
+    Returns how long importing `module` took, including everything it imported
+    """
+    for name, _, cumulative_us, _ in rows:
+        if name == module:
+            return cumulative_us / 1000
+
+    raise ValueError(module + " missing from the -X importtime output")
+
+
+def lazy_violations(rows):
+    """
+    Returns the LAZY_MODULES packages that were imported anyway
+    """
+    return sorted(
+        {
+            name.split(".")[0]
+            for name, _, _, _ in rows
+            if name.split(".")[0] in LAZY_MODULES
+        }
+    )
+
+
+# ------------------------------------------------------------------------------
+
+
+def run():
+    """
+    Measures, reports and checks the budget
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[2])
+    parser.add_argument("--module", default="firebot")
+    parser.add_argument("--budget", type=float, default=100, help="milliseconds")
+    parser.add_argument("--repeat", type=int, default=5, help="best of")
+    parser.add_argument("--top", type=int, default=15, help="modules to list")
+    args = parser.parse_args()
+
+    # The first run also warms the .pyc cache, so the fastest run is kept
+    runs = [measure(args.module) for _ in range(args.repeat)]
+    rows = min(runs, key=lambda this_rows: total_ms(this_rows, args.module))
+    took_ms = total_ms(rows, args.module)
+
+    print("%-40s %10s %10s" % ("module", "self ms", "cumul. ms"))
+    for name, self_us, cumulative_us, depth in sorted(
+        rows, key=lambda row: row[2], reverse=True
+    )[: args.top]:
+        print(
+            "%-40s %10.2f %10.2f"
+            % ("  " * depth + name, self_us / 1000, cumulative_us / 1000)
+        )
+
+    print()
+    print("import %s: %.1f ms (budget %.0f ms)" % (args.module, took_ms, args.budget))
+
+    failed = False
+
+    if took_ms > args.budget:
+        print("Over budget")
+        failed = True
+
+    violations = lazy_violations(rows)
+    if violations:
+        print("Imported at import time, should be lazy: " + ", ".join(violations))
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    run()
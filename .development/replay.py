@@ -0,0 +1,596 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./.development/replay.py
+
+Offline replay harness. Records a sequence of CAD snapshots from the live feed,
+or generates synthetic ones, then replays them at accelerated time through the
+real pipeline, recaps and delivery worker, with Telegram and Twilio pointed
+at local stand-in servers that can add latency, 429s and failures. Reports, per
+alert and recap, the time from the snapshot that caused it to each channel
+receiving it.
+
+    python3 .development/replay.py record DIR [--interval 60] [--count 60]
+    python3 .development/replay.py replay [DIR | --synthetic 200 --polls 10]
+        [--speed 60] [--subscribers 50] [--telegram-429 0.05] [--sms-fail 0.02]
+        [--env TELEGRAM_PER_MINUTE=600] [--report report.json]
+
+Snapshot files are named <unix time>.htm (WildWeb) or <unix time>.json
+(WildWeb-E). A forest's directory in the raw CAD archive (STORE_RAW_CAD, see
+archive.py) can be replayed too, limited with --since/--until. Time between
+snapshots is divided by --speed; delivery (rate limits, retry backoff) runs in
+real time. Incident history, rollups and recaps (RECAPS defaults to
+day,week,month here) follow the snapshot times instead. Synthetic snapshots
+start a second before RECAP_TIME on 2025-02-28, the end of a day and a month.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+from dotenv import dotenv_values
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import benchmark  # pylint: disable=wrong-import-position
+
+sys.path.insert(0, benchmark.repo_path)
+import archive  # pylint: disable=wrong-import-position
+
+# Pull the incident ID out of each kind of notification body
+ALERT_PATTERNS = (
+    ("new", re.compile(r"\nID: (\S+)")),
+    ("change", re.compile(r"^Dispatch changed <b>(?:<a [^>]*>)?([^<]+)")),
+    ("change", re.compile(r"^(\S+) Changed:")),
+    ("recap", re.compile(r"^<b>(\w+) Recap:</b>")),
+)
+
+# Synthetic feeds are dated February 2025, see benchmark.synthetic_incidents()
+SYNTHETIC_RECAP_DAY = datetime.date(2025, 2, 28)
+
+# ------------------------------------------------------------------------------
+
+
+class StubState:
+    """
+    Behaviour and receipts of one stand-in server
+    """
+
+    def __init__(self, name, latency, rate_429, fail_rate, seed):
+        self.name = name
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.receipts = []  # (perf_counter time, recipient, text)
+        self.served = {"ok": 0, "429": 0, "failed": 0}
+
+    def outcome(self):
+        """
+        Picks ok, 429 or failed for a request, after the simulated latency
+        """
+        time.sleep(self.latency)
+
+        with self.lock:
+            roll = self.rng.random()
+
+            if roll < self.fail_rate:
+                result = "failed"
+            elif roll < self.fail_rate + self.rate_429:
+                result = "429"
+            else:
+                result = "ok"
+
+            self.served[result] += 1
+            return result
+
+    def receive(self, recipient, text):
+        """
+        Records a delivered message. Returns its sequence number
+        """
+        with self.lock:
+            self.receipts.append((time.perf_counter(), recipient, text))
+            return len(self.receipts)
+
+
+def stub_handler(state, handle_post):
+    """
+    Returns a request handler class that passes POSTs to handle_post()
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        """
+        Quiet JSON request handler
+        """
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """
+            Reads the body and replies with handle_post()'s (status, JSON)
+            """
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            status, payload = handle_post(state, self.path, body)
+            response = json.dumps(payload).encode("utf-8")
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    return Handler
+
+
+def telegram_post(state, path, body):
+    """
+    Stand-in for the Bot API's sendMessage
+    """
+    if not path.endswith("/sendMessage"):
+        return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+
+    outcome = state.outcome()
+
+    if outcome == "failed":
+        return 500, {"ok": False, "error_code": 500, "description": "Stub failure"}
+
+    if outcome == "429":
+        return 429, {
+            "ok": False,
+            "error_code": 429,
+            "description": "Too Many Requests: retry after 1",
+            "parameters": {"retry_after": 1},
+        }
+
+    message = json.loads(body)
+    message_id = state.receive(message["chat_id"], message["text"])
+
+    return 200, {"ok": True, "result": {"message_id": message_id, "text": message["text"]}}
+
+
+def twilio_post(state, path, body):
+    """
+    Stand-in for Twilio's Messages.json create
+    """
+    if not path.endswith("/Messages.json"):
+        return 404, {"code": 20404, "message": "Not Found", "status": 404}
+
+    outcome = state.outcome()
+
+    if outcome == "failed":
+        return 500, {"code": 20500, "message": "Stub failure", "status": 500}
+
+    if outcome == "429":
+        return 429, {"code": 20429, "message": "Too Many Requests", "status": 429}
+
+    form = parse_qs(body.decode("utf-8"))
+    sequence = state.receive(form["To"][0], form["Body"][0])
+
+    return 201, {
+        "sid": "SM%032d" % sequence,
+        "status": "queued",
+        "to": form["To"][0],
+        "from": form["From"][0],
+        "body": form["Body"][0],
+    }
+
+
+def start_stub(state, handle_post):
+    """
+    Serves a stand-in on a free local port from a background thread. Returns
+    its base URL
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), stub_handler(state, handle_post))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:" + str(server.server_address[1])
+
+
+# ------------------------------------------------------------------------------
+
+
+def load_snapshots(path, start=None, end=None):
+    """
+    Returns [(unix time, format, payload)] for a directory of recorded snapshots,
+    or for one forest's directory in the raw CAD archive (EG: cad-archive/ANF),
+    optionally limited to fetches between `start` and `end`
+    """
+    if any(filename.endswith(".idx") for filename in os.listdir(path)):
+        raw_archive = archive.SnapshotArchive(os.path.dirname(os.path.abspath(path)))
+        return [
+            (fetched, fmt, payload.decode("utf-8"))
+            for fetched, fmt, payload in raw_archive.snapshots(
+                os.path.basename(os.path.abspath(path)), start, end
+            )
+        ]
+
+    snapshots = []
+
+    for filename in sorted(os.listdir(path)):
+        stem, extension = os.path.splitext(filename)
+
+        if extension not in (".htm", ".json") or not stem.replace(".", "").isdigit():
+            continue
+
+        with open(os.path.join(path, filename), encoding="utf-8") as snapshot_file:
+            snapshots.append(
+                (
+                    float(stem),
+                    "wildweb-e" if extension == ".json" else "wildweb",
+                    snapshot_file.read(),
+                )
+            )
+
+    return sorted(snapshots, key=lambda snapshot: snapshot[0])
+
+
+def iso_time(value):
+    """
+    Parses an ISO 8601 time, UTC unless it says otherwise, into a unix time
+    """
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def synthetic_snapshots(size, polls, interval, fmt, seed, start=0):
+    """
+    Returns [(unix time, format, payload)]: a synthetic feed, churned each
+    poll, from unix time `start`
+    """
+    rng = random.Random(seed)
+    incidents = benchmark.synthetic_incidents(size, rng)
+    snapshots = []
+
+    for poll in range(polls):
+        snapshots.append(
+            (start + poll * interval, fmt, benchmark.FORMATS[fmt](incidents))
+        )
+        incidents = benchmark.churn(incidents, rng)
+
+    return snapshots
+
+
+def record(path, interval, count):
+    """
+    Saves `count` snapshots of the live feed configured in the repo's .env,
+    `interval` seconds apart
+    """
+    secrets = dotenv_values(os.path.join(benchmark.repo_path, ".env"))
+
+    if secrets.get("WILDWEB_E"):
+        url = (
+            "https://snknmqmon6.execute-api.us-west-2.amazonaws.com/centers/"
+            + secrets["NF_WWE_IDENTIFIER"].upper()
+            + "/incidents"
+        )
+        extension = ".json"
+    else:
+        url = "http://www.wildcad.net/WCCA-" + secrets["NF_IDENTIFIER"] + "recent.htm"
+        extension = ".htm"
+
+    os.makedirs(path, exist_ok=True)
+
+    for number in range(count):
+        started = time.time()
+
+        try:
+            response = requests.get(url, timeout=30)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as error:
+            print("Fetch failed: " + str(error))
+        else:
+            filename = os.path.join(path, "%d%s" % (started, extension))
+            with open(filename, "w", encoding="utf-8") as snapshot_file:
+                snapshot_file.write(response.text)
+            print("Saved " + filename)
+
+        if number < count - 1:
+            time.sleep(max(0, interval - (time.time() - started)))
+
+
+# ------------------------------------------------------------------------------
+
+
+def alert_key(body):
+    """
+    Returns (kind, incident ID) for a notification body, EG: ("new", "ANF-2777"),
+    or ("recap", "Daily")
+    """
+    for kind, pattern in ALERT_PATTERNS:
+        match = pattern.search(body)
+        if match:
+            return kind, match.group(1)
+
+    return "other", None
+
+
+async def replay(firebot, snapshots, speed, drain_timeout):
+    """
+    Feeds each snapshot through process_forest() and process_recaps() on
+    schedule, at the snapshot's time, while the daemon's delivery worker sends
+    what they queue. Returns [queued alert dicts]
+    """
+    this_forest = firebot.build_forest("ANF", snapshots[0][1] == "wildweb-e" and "caancc")
+    conn = firebot.store.conn
+    queued = []
+    last_seq = 0
+
+    delivery_worker = asyncio.ensure_future(firebot.run_delivery_worker())
+    await asyncio.sleep(0)  # Lets the lanes register their wakeups
+
+    started = time.perf_counter()
+
+    for number, (snapshot_time, _, payload) in enumerate(snapshots):
+        due = started + (snapshot_time - snapshots[0][0]) / speed
+        await asyncio.sleep(max(0, due - time.perf_counter()))
+
+        injected = time.perf_counter()
+        firebot.use_forest(this_forest)
+        firebot.process_forest(payload, snapshot_time)
+        firebot.process_recaps(datetime.datetime.fromtimestamp(snapshot_time))
+
+        # Rows with a recipient are the worker's per-recipient retries, not alerts
+        for row in conn.execute(
+            "SELECT seq, channel, body FROM outbox"
+            + " WHERE seq > ? AND recipient IS NULL ORDER BY seq",
+            (last_seq,),
+        ):
+            kind, inci_id = alert_key(row["body"])
+            queued.append(
+                {
+                    "snapshot": number,
+                    "injected": injected,
+                    "queued_after": time.perf_counter() - injected,
+                    "channel": row["channel"],
+                    "kind": kind,
+                    "id": inci_id,
+                    "body": row["body"],
+                }
+            )
+            last_seq = row["seq"]
+
+        for wakeup in firebot.outbox_wakeups:
+            wakeup.set()
+
+        print(
+            "Snapshot %d/%d: %d messages queued so far"
+            % (number + 1, len(snapshots), len(queued)),
+            file=sys.stderr,
+        )
+
+    # Wait for the outbox to drain, retries included
+    deadline = time.perf_counter() + drain_timeout
+    while time.perf_counter() < deadline:
+        pending = conn.execute(
+            "SELECT COUNT(*) FROM outbox WHERE state NOT IN ('sent', 'skipped', 'failed')"
+        ).fetchone()[0]
+        if pending == 0:
+            break
+        await asyncio.sleep(0.2)
+
+    delivery_worker.cancel()
+
+    return queued
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a non-empty list
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def match_receipts(queued, stubs):
+    """
+    Adds first/last receipt latency and recipient count to each queued alert
+    """
+    receipts = {}
+
+    for channel, state in stubs.items():
+        for received, _, text in state.receipts:
+            receipts.setdefault((channel, text), []).append(received)
+
+    for alert in queued:
+        times = receipts.get((alert["channel"], alert["body"]), [])
+        alert["received"] = len(times)
+        alert["first_latency"] = min(times) - alert["injected"] if times else None
+        alert["last_latency"] = max(times) - alert["injected"] if times else None
+
+
+def print_report(queued, stubs, outbox_states):
+    """
+    Prints per-alert latencies and a per-channel summary
+    """
+    print(
+        "%-5s %-9s %-7s %-14s %9s %10s %10s"
+        % ("snap", "channel", "kind", "incident", "received", "first s", "last s")
+    )
+
+    for alert in queued:
+        print(
+            "%-5d %-9s %-7s %-14s %9d %10s %10s"
+            % (
+                alert["snapshot"],
+                alert["channel"],
+                alert["kind"],
+                alert["id"] or "-",
+                alert["received"],
+                "-" if alert["first_latency"] is None else "%.3f" % alert["first_latency"],
+                "-" if alert["last_latency"] is None else "%.3f" % alert["last_latency"],
+            )
+        )
+
+    print()
+    print("%-9s %-7s %6s %9s %9s %9s %9s" % ("channel", "kind", "alerts", "p50 s", "p95 s", "max s", "missing"))
+
+    for channel in stubs:
+        for kind in ("new", "change", "recap", "other"):
+            alerts = [a for a in queued if a["channel"] == channel and a["kind"] == kind]
+            latencies = [a["first_latency"] for a in alerts if a["first_latency"] is not None]
+
+            if not alerts:
+                continue
+
+            print(
+                "%-9s %-7s %6d %9s %9s %9s %9d"
+                % (
+                    channel,
+                    kind,
+                    len(alerts),
+                    "%.3f" % percentile(latencies, 0.5) if latencies else "-",
+                    "%.3f" % percentile(latencies, 0.95) if latencies else "-",
+                    "%.3f" % max(latencies) if latencies else "-",
+                    len(alerts) - len(latencies),
+                )
+            )
+
+    recaps = [alert for alert in queued if alert["kind"] == "recap"]
+    if recaps:
+        print()
+        for alert in recaps:
+            print(
+                "Snapshot %d recap: %s"
+                % (alert["snapshot"], re.sub("<[^>]+>", "", alert["body"]))
+            )
+
+    print()
+    for channel, state in stubs.items():
+        print(channel + " stand-in served: " + json.dumps(state.served))
+    print("Outbox: " + json.dumps(outbox_states))
+
+
+def run_replay(args):
+    """
+    Sets up the stand-ins and a throwaway FireBot, replays, then reports
+    """
+    if args.snapshots:
+        snapshots = load_snapshots(args.snapshots, args.since, args.until)
+
+        if not snapshots:
+            sys.exit("No snapshots to replay")
+
+    stubs = {
+        "telegram": StubState(
+            "telegram", args.telegram_latency, args.telegram_429, args.telegram_fail, args.seed
+        ),
+        "sms": StubState("sms", args.sms_latency, args.sms_429, args.sms_fail, args.seed + 1),
+    }
+
+    env = {
+        "RECAPS": "day,week,month",
+        "TELEGRAM_BOT_ID": "botreplay",
+        "TELEGRAM_BOT_SECRET": "secret",
+        "TELEGRAM_CHAT_ID": "@replay",
+        "TELEGRAM_API_URL": start_stub(stubs["telegram"], telegram_post),
+        "TWILIO_SID": "AC" + "0" * 32,
+        "TWILIO_AUTH_TOKEN": "secret",
+        "TWILIO_NUMBER": "+15550000000",
+        "TWILIO_API_URL": start_stub(stubs["sms"], twilio_post),
+    }
+    for pair in args.env:
+        key, _, value = pair.partition("=")
+        env[key] = value
+
+    work_path = tempfile.mkdtemp(prefix="firebot-replay-")
+    firebot = benchmark.load_firebot(work_path, env)
+    benchmark.use_fresh_db(firebot, work_path, "replay")
+
+    if not args.snapshots:  # Crosses RECAP_TIME after the first snapshot
+        snapshots = synthetic_snapshots(
+            args.synthetic,
+            args.polls,
+            args.interval,
+            args.format,
+            args.seed,
+            datetime.datetime.combine(
+                SYNTHETIC_RECAP_DAY, datetime.time(*firebot.config["recap_time"])
+            ).timestamp()
+            - 1,
+        )
+
+    for number in range(args.subscribers):
+        firebot.store.add_contact(
+            {"number": "+1555%07d" % number, "forest": "ANF", "alert_level": "all"}
+        )
+
+    queued = asyncio.run(replay(firebot, snapshots, args.speed, args.drain_timeout))
+    match_receipts(queued, stubs)
+
+    outbox_states = dict(
+        firebot.store.conn.execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall()
+    )
+    print_report(queued, stubs, outbox_states)
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as report_file:
+            json.dump(
+                {
+                    "alerts": [
+                        {key: value for key, value in alert.items() if key != "injected"}
+                        for alert in queued
+                    ],
+                    "served": {channel: state.served for channel, state in stubs.items()},
+                    "outbox": outbox_states,
+                },
+                report_file,
+                indent=2,
+            )
+        print("Saved " + args.report)
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record or replay CAD snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="save live feed snapshots")
+    record_parser.add_argument("path")
+    record_parser.add_argument("--interval", type=float, default=60)
+    record_parser.add_argument("--count", type=int, default=60)
+
+    replay_parser = commands.add_parser("replay", help="replay snapshots offline")
+    replay_parser.add_argument(
+        "snapshots", nargs="?", help="directory of snapshots, or cad-archive/<NF>"
+    )
+    replay_parser.add_argument("--since", type=iso_time, help="UTC, EG: 2025-08-01T14:00")
+    replay_parser.add_argument("--until", type=iso_time, help="UTC")
+    replay_parser.add_argument("--synthetic", type=int, default=200, help="feed size")
+    replay_parser.add_argument("--polls", type=int, default=10)
+    replay_parser.add_argument("--interval", type=float, default=60, help="seconds")
+    replay_parser.add_argument("--format", choices=benchmark.FORMATS, default="wildweb-e")
+    replay_parser.add_argument("--seed", type=int, default=1)
+    replay_parser.add_argument("--speed", type=float, default=60, help="time acceleration")
+    replay_parser.add_argument("--subscribers", type=int, default=10)
+    replay_parser.add_argument("--telegram-latency", type=float, default=0.05)
+    replay_parser.add_argument("--telegram-429", type=float, default=0.0)
+    replay_parser.add_argument("--telegram-fail", type=float, default=0.0)
+    replay_parser.add_argument("--sms-latency", type=float, default=0.05)
+    replay_parser.add_argument("--sms-429", type=float, default=0.0)
+    replay_parser.add_argument("--sms-fail", type=float, default=0.0)
+    replay_parser.add_argument("--drain-timeout", type=float, default=120)
+    replay_parser.add_argument("--env", action="append", default=[], help="KEY=VALUE for .env")
+    replay_parser.add_argument("--report", help="save per-alert results as JSON")
+
+    cli_args = parser.parse_args()
+
+    if cli_args.command == "record":
+        record(cli_args.path, cli_args.interval, cli_args.count)
+    else:
+        run_replay(cli_args)
@@ -1,8 +1,11 @@
-import tinydb
+import sys
+from dotenv import dotenv_values
 
-db = tinydb.TinyDB('../../db.json')
-last_record = db.all()[-1]
+sys.path.insert(0, '../..')
+from store import Store
 
-inci_db = tinydb.Query()
+forest = dotenv_values('../../.env')['NF_IDENTIFIER']
+store = Store()
+last_record = store.all_incidents(forest)[-1]
 
-db.remove(inci_db.id == last_record['id'])
+store.remove_incident(forest, last_record['id'])
@@ -1,13 +1,16 @@
-import tinydb
+import sys
+from dotenv import dotenv_values
 
-db = tinydb.TinyDB('../../db.json')
-last_record = db.all()[-1]
+sys.path.insert(0, '../..')
+from store import Store
 
-inci_db = tinydb.Query()
+forest = dotenv_values('../../.env')['NF_IDENTIFIER']
+store = Store()
 
-inci = db.search(inci_db.type == 'Wildfire')
+inci = [inci for inci in store.all_incidents(forest) if inci['type'] == 'Wildfire']
 inci = inci[0]
 
 inci['resources'] = 'LM-717'
+inci.pop('fingerprint', None)  # Otherwise FireBot sees the feed row as unchanged
 
-db.update(inci,inci_db.id == inci['id'])
+store.save_incident(forest, inci)
@@ -0,0 +1,248 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./archive.py
+
+Append-only archive of raw CAD payloads (WildWeb HTML and WildWeb-E JSON), for
+incident reviews and replays. A payload identical to the previous one for its
+forest is not stored again. Payloads are zlib-compressed into one segment file
+per forest per UTC day, next to a fixed-width index of fetch times, so the
+snapshot in force at any minute is found with a binary search instead of a scan.
+Segments older than the retention period are deleted.
+
+    cad-archive/ANF/2025-08-01.cad  Concatenated compressed payloads
+    cad-archive/ANF/2025-08-01.idx  One INDEX_RECORD per payload
+
+Snapshots can be listed and extracted (times in UTC) with:
+    python3 archive.py list NF_IDENTIFIER [YYYY-MM-DD]
+    python3 archive.py at NF_IDENTIFIER YYYY-MM-DDTHH:MM > snapshot
+"""
+
+import bisect
+import datetime
+import hashlib
+import os
+import struct
+import sys
+import time
+import zlib
+from dotenv import dotenv_values
+
+exec_path = os.path.dirname(os.path.realpath(__file__))
+ARCHIVE_PATH = exec_path + "/cad-archive"
+
+# Fetch time, payload offset and compressed length in the .cad file, payload
+# digest, and format (0 = WildWeb HTML, 1 = WildWeb-E JSON)
+INDEX_RECORD = struct.Struct("<dQI16sB")
+FORMATS = ("wildweb", "wildweb-e")
+
+# ------------------------------------------------------------------------------
+
+
+def segment_name(fetched):
+    """
+    Returns the segment a fetch time belongs to, EG: 2025-08-01
+    """
+    return datetime.datetime.fromtimestamp(fetched, datetime.timezone.utc).strftime(
+        "%Y-%m-%d"
+    )
+
+
+def payload_digest(payload):
+    """
+    Returns the digest used to spot repeated payloads
+    """
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+class SnapshotArchive:
+    """
+    The archive under `path`, one subdirectory per forest
+    """
+
+    def __init__(self, path=None, retention_days=30):
+        self.path = path or ARCHIVE_PATH
+        self.retention_days = retention_days
+        self.last_digests = {}  # Forest -> digest of its newest payload
+
+    def forest_path(self, forest):
+        """
+        Returns (and creates) the forest's directory
+        """
+        path = os.path.join(self.path, forest)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def segments(self, forest):
+        """
+        Returns the forest's segment names, oldest first
+        """
+        return sorted(
+            filename[:-4]
+            for filename in os.listdir(self.forest_path(forest))
+            if filename.endswith(".idx")
+        )
+
+    def read_index(self, forest, segment):
+        """
+        Returns a segment's index records. A record cut short by a crash
+        mid-write is ignored
+        """
+        with open(
+            os.path.join(self.forest_path(forest), segment + ".idx"), "rb"
+        ) as index_file:
+            data = index_file.read()
+
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        return list(INDEX_RECORD.iter_unpack(data[:usable]))
+
+    def last_digest(self, forest):
+        """
+        Returns the digest of the forest's newest payload, None if it has none
+        """
+        if forest not in self.last_digests:
+            self.last_digests[forest] = None
+
+            for segment in reversed(self.segments(forest)):
+                records = self.read_index(forest, segment)
+                if records:
+                    self.last_digests[forest] = records[-1][3]
+                    break
+
+        return self.last_digests[forest]
+
+    # --------------------------------------------------------------------------
+
+    def add(self, forest, payload, wildweb_e, fetched=None):
+        """
+        Archives a payload (str or bytes) fetched at `fetched` (default: now).
+        Returns False if it is identical to the previous one and was skipped
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        fetched = time.time() if fetched is None else fetched
+        digest = payload_digest(payload)
+
+        if digest == self.last_digest(forest):
+            return False
+
+        segment = os.path.join(self.forest_path(forest), segment_name(fetched))
+        compressed = zlib.compress(payload, 6)
+
+        # Payload first: an index record never points at bytes not yet written
+        with open(segment + ".cad", "ab") as segment_file:
+            offset = segment_file.tell()
+            segment_file.write(compressed)
+
+        with open(segment + ".idx", "ab") as index_file:
+            index_file.write(
+                INDEX_RECORD.pack(fetched, offset, len(compressed), digest, int(wildweb_e))
+            )
+
+        self.last_digests[forest] = digest
+
+        return True
+
+    def read(self, forest, segment, record):
+        """
+        Returns (fetched, format, payload bytes) for an index record
+        """
+        fetched, offset, length, _, fmt = record
+
+        with open(
+            os.path.join(self.forest_path(forest), segment + ".cad"), "rb"
+        ) as segment_file:
+            segment_file.seek(offset)
+            payload = zlib.decompress(segment_file.read(length))
+
+        return fetched, FORMATS[fmt], payload
+
+    def at(self, forest, when):
+        """
+        Returns (fetched, format, payload bytes) for the snapshot in force at
+        unix time `when`: the newest one fetched at or before it. None if the
+        archive starts later
+        """
+        segments = self.segments(forest)
+        position = bisect.bisect_right(segments, segment_name(when))
+
+        # Days with no new payload have no segment, so walk back to the last one
+        for segment in reversed(segments[:position]):
+            records = self.read_index(forest, segment)
+            found = bisect.bisect_right([record[0] for record in records], when)
+
+            if found:
+                return self.read(forest, segment, records[found - 1])
+
+        return None
+
+    def snapshots(self, forest, start=None, end=None):
+        """
+        Yields (fetched, format, payload bytes) for every snapshot fetched
+        between `start` and `end` (unix times, inclusive), oldest first
+        """
+        for segment in self.segments(forest):
+            if start is not None and segment < segment_name(start):
+                continue
+            if end is not None and segment > segment_name(end):
+                break
+
+            for record in self.read_index(forest, segment):
+                if (start is None or record[0] >= start) and (
+                    end is None or record[0] <= end
+                ):
+                    yield self.read(forest, segment, record)
+
+    def prune(self, now=None):
+        """
+        Deletes every forest's segments older than the retention period
+        """
+        if not os.path.isdir(self.path):
+            return
+
+        now = time.time() if now is None else now
+        oldest_kept = segment_name(now - self.retention_days * 86400)
+
+        for forest in os.listdir(self.path):
+            for segment in self.segments(forest):
+                if segment >= oldest_kept:
+                    break
+
+                for extension in (".idx", ".cad"):
+                    os.remove(os.path.join(self.path, forest, segment + extension))
+
+
+# ------------------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    archive = SnapshotArchive(dotenv_values(exec_path + "/.env").get("RAW_CAD_PATH"))
+
+    if len(sys.argv) > 2 and sys.argv[1] == "list":
+        for cli_segment in archive.segments(sys.argv[2]):
+            if len(sys.argv) > 3 and cli_segment != sys.argv[3]:
+                continue
+            for cli_record in archive.read_index(sys.argv[2], cli_segment):
+                print(
+                    datetime.datetime.fromtimestamp(
+                        cli_record[0], datetime.timezone.utc
+                    ).isoformat(timespec="seconds"),
+                    FORMATS[cli_record[4]],
+                    cli_record[2],
+                    "bytes compressed",
+                )
+    elif len(sys.argv) > 3 and sys.argv[1] == "at":
+        cli_when = datetime.datetime.fromisoformat(sys.argv[3])
+        if cli_when.tzinfo is None:
+            cli_when = cli_when.replace(tzinfo=datetime.timezone.utc)
+        cli_snapshot = archive.at(sys.argv[2], cli_when.timestamp())
+        if cli_snapshot is None:
+            sys.exit("No snapshot that early")
+        sys.stdout.buffer.write(cli_snapshot[2])
+    else:
+        print(
+            "Usage: python3 archive.py list NF_IDENTIFIER [YYYY-MM-DD]\n"
+            + "       python3 archive.py at NF_IDENTIFIER YYYY-MM-DDTHH:MM"
+        )
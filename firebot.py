@@ -8,82 +8,235 @@ Scrapes WildWeb for US National Forest fire-related data, and reports them to a
 given Telegram channel
 """
 
-import urllib.parse
 import datetime
+import functools
 import logging
 import os
 import sys
 import json
-import re
-import json_log_formatter
-import requests
-import tinydb
-from twilio.rest import Client
+import time
+import hashlib
+import sqlite3
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 from dotenv import dotenv_values
-from lxml import html
+from store import Store, ShortUrls, Contacts, period_start as store_period_start
+from archive import SnapshotArchive
+from incident import Incident, ResourceChange, diff_incidents, parse_acres, resource_set
+from metrics import Metrics, summary as metrics_summary
 
-# Initialize JSON logging
-formatter = json_log_formatter.JSONFormatter()
-
-json_handler = logging.FileHandler(filename="./firebot-log.json")
-json_handler.setFormatter(formatter)
+# Heavy backends (aiohttp, requests, twilio, lxml, json_log_formatter) are
+# imported where they are first used, so a run only pays for the WildCAD source
+# and output channels it actually touches. See .development/importtime.py
 
 logger = logging.getLogger("firebot_json")
-logger.addHandler(json_handler)
+logger.setLevel(logging.ERROR)
 
-# ------------------------------------------------------------------------------
+# One structured summary line per run/poll, whatever the log level
+summary_logger = logging.getLogger("firebot_summary")
+summary_logger.setLevel(logging.INFO)
+summary_logger.propagate = False
 
 DEBUG = False
 MOCK_DATA = False
-logger.setLevel(logging.ERROR)
+DAEMON = False
 
 exec_path = os.path.dirname(os.path.realpath(__file__))
-db = tinydb.TinyDB(exec_path + "/db.json")
-db_contacts = tinydb.TinyDB(exec_path + "/db_contacts.json")
-db_urls = tinydb.TinyDB(exec_path + "/db_urls.json")
+
+# Filled in by setup(): importing this module reads no files and opens no DB
+secrets = {}
+config = {}
+forests = []
+forest = None  # The forest currently being processed, see use_forest()
+store = None
+short_urls = None
+contacts = None  # Recipient lists, reloaded only when subscribers change
+raw_archive = None  # SnapshotArchive, when STORE_RAW_CAD is set
+metrics = Metrics()  # Flushed to the DB (served by server.py) by flush_metrics()
+outbox_wakeups = []  # asyncio.Events of the daemon's delivery lanes
+poll_budgets = {}  # Daemon: WildCAD host -> TokenBucket, see poll_budget()
+OUTBOX_MAX_ATTEMPTS = 8
 
 # ------------------------------------------------------------------------------
-"""
-Sets up user-defined parameters, and their defaults
-"""
 
-secrets = dotenv_values(".env")
-config = {}
 
+def setup_logging():
+    """
+    Sends both loggers to ./firebot-log.json, one JSON object per line
+    """
+    import json_log_formatter  # pylint: disable=import-outside-toplevel
 
-if "WILDWEB_E" in secrets:
-    config["wildcad_url"] = (
-        "https://snknmqmon6.execute-api.us-west-2.amazonaws.com/centers/"
-        + secrets["NF_WWE_IDENTIFIER"].upper()
-        + "/incidents"
-    )
+    json_handler = logging.FileHandler(filename="./firebot-log.json")
+    json_handler.setFormatter(json_log_formatter.JSONFormatter())
 
-    if "NF_WWE_IDENTIFIER" not in secrets:
+    logger.addHandler(json_handler)
+    summary_logger.addHandler(json_handler)
+
+
+def load_config(env):
+    """
+    Returns user-defined parameters from .env, with their defaults
+    """
+    poll_interval = float(env.get("POLL_INTERVAL", 60))
+    poll_floor = float(env.get("POLL_FLOOR", min(15, poll_interval)))
+
+    return {
+        "poll_interval": poll_interval,
+        # Daemon only: adaptive polling between these bounds, see poll_delay()
+        "poll_floor": poll_floor,
+        "poll_ceiling": float(env.get("POLL_CEILING", max(180, poll_interval))),
+        "poll_active_window": float(env.get("POLL_ACTIVE_WINDOW", 600)),
+        "poll_jitter": float(env.get("POLL_JITTER", 0.1)),
+        # Per forest. None: enough to poll at the floor for good, see poll_budget()
+        "poll_max_per_hour": (
+            float(env["POLL_MAX_PER_HOUR"]) if "POLL_MAX_PER_HOUR" in env else None
+        ),
+        "sms_workers": int(env.get("SMS_WORKERS", 8)),
+        "twilio_mps": float(env.get("TWILIO_MPS", 0)),  # 0 = no client-side cap
+        "telegram_per_minute": float(env.get("TELEGRAM_PER_MINUTE", 20)),
+        "telegram_api_url": env.get(
+            "TELEGRAM_API_URL", "https://api.telegram.org"
+        ).rstrip("/"),
+        "twilio_api_url": (env.get("TWILIO_API_URL") or "").rstrip("/"),
+        "recaps": [
+            period.strip()
+            for period in env.get("RECAPS", "day").split(",")
+            if period.strip() in ("day", "week", "month")
+        ],
+        "recap_time": tuple(
+            int(part) for part in env.get("RECAP_TIME", "23:59").split(":")
+        ),
+        "telegram_chat_ids": [
+            chat_id.strip()
+            for chat_id in env.get("TELEGRAM_CHAT_ID", "").split(",")
+            if chat_id.strip()
+        ],
+    }
+
+
+def build_forest(nf_identifier, wwe_identifier=False):
+    """
+    Returns the per-forest settings and state namespace, EG: ANF on WildWeb, or
+    ANF on WildWeb-E as center "caancc"
+    """
+    if wwe_identifier:
+        wildcad_url = (
+            "https://snknmqmon6.execute-api.us-west-2.amazonaws.com/centers/"
+            + wwe_identifier.upper()
+            + "/incidents"
+        )
+    else:
+        wildcad_url = "http://www.wildcad.net/WCCA-" + nf_identifier + "recent.htm"
+
+    return {
+        "nf_identifier": nf_identifier,
+        "wildweb_e": bool(wwe_identifier),
+        "wildcad_url": wildcad_url,
+        "incidents": None,  # IncidentState while the forest is processed
+        "ignored_fingerprints": {},  # ID -> fingerprint of feed rows not stored
+        "last_activity": 0.0,  # Last time a fire was new, changed or growing
+        "idle_polls": 0,  # Polls in a row that found nothing new in the feed
+        "next_poll": 0.0,  # Daemon: when this forest is due to be fetched again
+    }
+
+
+def load_forests(env):
+    """
+    Returns the forests to poll, from FORESTS or NF_IDENTIFIER/NF_WWE_IDENTIFIER
+    """
+    if "FORESTS" in env:  # EG: FORESTS=ANF:caancc,LPF
+        this_forests = []
+        for forest_str in env["FORESTS"].split(","):
+            forest_split = forest_str.strip().split(":")
+            this_forests.append(
+                build_forest(forest_split[0], len(forest_split) > 1 and forest_split[1])
+            )
+        return this_forests
+
+    if env["WILDWEB_E"]:
+        return [build_forest(env["NF_IDENTIFIER"], env["NF_WWE_IDENTIFIER"])]
+
+    return [build_forest(env["NF_IDENTIFIER"])]
+
+
+def use_forest(this_forest):
+    """
+    Points the processing functions at the given forest's settings
+    """
+    global forest  # pylint: disable=global-statement
+
+    forest = this_forest
+
+
+def setup(argv):
+    """
+    Reads .env and the command-line options, and opens the DB. Everything a
+    run needs besides the imports at the top of this file, done by main()
+    rather than at import time
+    """
+    # pylint: disable=global-statement
+    global DEBUG, MOCK_DATA, DAEMON, secrets, config, forests, store, short_urls, contacts
+    global raw_archive
+
+    setup_logging()
+
+    secrets = dotenv_values(".env")
+    config = load_config(secrets)
+
+    if "WILDWEB_E" in secrets:
+        if "NF_WWE_IDENTIFIER" not in secrets:
+            logger.error(
+                "You have set WILDWEB_E but not NF_WWE_IDENTIFIER in .env. Cannot continue"
+            )
+            sys.exit(1)
+    else:
+        secrets["WILDWEB_E"] = False
+
+    forests = load_forests(secrets)
+    use_forest(forests[0])
+
+    for arg in argv:
+        if arg == "debug":
+            DEBUG = True
+            logger.setLevel(logging.DEBUG)
+            logger.debug("Debug log level")
+
+        if arg == "mock":
+            MOCK_DATA = True
+            for this_forest in forests:
+                if this_forest["wildweb_e"]:
+                    this_forest["wildcad_url"] = ".development/wildweb-e_mock_data.json"
+                else:
+                    this_forest["wildcad_url"] = ".development/wildcad_mock_data.htm"
+                logger.debug("Using mock data: %s", this_forest["wildcad_url"])
+
+        if arg == "daemon":
+            DAEMON = True
+            logger.debug("Daemon mode")
+
+    if DAEMON and config["poll_floor"] <= 0:
         logger.error(
-            "You have set WILDWEB_E but not NF_WWE_IDENTIFIER in .env. Cannot continue"
+            "POLL_FLOOR (or POLL_INTERVAL, when lower) must be above 0 in .env."
+            + " Cannot continue"
         )
         sys.exit(1)
-else:
-    secrets["WILDWEB_E"] = False
-    config["wildcad_url"] = (
-        "http://www.wildcad.net/WCCA-" + secrets["NF_IDENTIFIER"] + "recent.htm"
-    )
 
-# ------------------------------------------------------------------------------
+    store = Store(legacy_forest=secrets.get("NF_IDENTIFIER"))
+    short_urls = ShortUrls(store, preload=DAEMON)  # Cron runs skip the full index
+    contacts = Contacts(store)
 
-for arg in sys.argv:
-    if arg == "debug":
-        DEBUG = True
-        logger.setLevel(logging.DEBUG)
-        logger.debug("Debug log level")
+    if secrets.get("STORE_RAW_CAD") == "True":
+        raw_archive = SnapshotArchive(
+            secrets.get("RAW_CAD_PATH"), int(secrets.get("RAW_CAD_RETENTION_DAYS", 30))
+        )
+
+    for this_forest in forests:
+        # Validators and digest of the last payload we fully processed
+        this_forest["fetch_state"] = store.get_fetch_state(this_forest["nf_identifier"])
 
-    if arg == "mock":
-        MOCK_DATA = True
-        if secrets["WILDWEB_E"]:
-            config["wildcad_url"] = ".development/wildweb-e_mock_data.json"
-        else:
-            config["wildcad_url"] = ".development/wildcad_mock_data.htm"
-        logger.debug("Using mock data: %s", config["wildcad_url"])
 
 # ------------------------------------------------------------------------------
 
@@ -102,20 +255,80 @@ def search_attrs(arr, keyname, search):
 # ------------------------------------------------------------------------------
 
 
-def utf8_encode(input_str):
+class TokenBucket:
     """
-    Prepares a string for downstream curl by making ASCII Hexadecimal
-    replacements. EG: "# 123" becomes "%23 123"
+    Thread-safe token bucket: take() blocks until a token is available. Tokens
+    refill at per_second (0 = unlimited), up to capacity. pause() empties the
+    bucket for a while, EG: when an API answers HTTP 429
     """
-    return urllib.parse.quote_plus(input_str)
+
+    def __init__(self, per_second, capacity=1):
+        self.per_second = per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        """
+        Adds the tokens earned since the last refill. Call with the lock held
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.per_second
+        )
+        self.updated = now
+
+    def delay(self):
+        """
+        Returns how many seconds take() would block for, 0 if a token is ready
+        """
+        if not self.per_second:
+            return 0
+
+        with self.lock:
+            self.refill()
+            return max(0, (1 - self.tokens) / self.per_second)
+
+    def take(self):
+        """
+        Blocks until a token is available, then consumes it
+        """
+        if not self.per_second:
+            return
+
+        while True:
+            with self.lock:
+                self.refill()
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.per_second
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hands out no tokens for the given number of seconds
+        """
+        with self.lock:
+            self.tokens = -seconds * self.per_second
+            self.updated = time.monotonic()
 
 
 # ------------------------------------------------------------------------------
 
 
-def send_sms(message_str):
+sms = {"client": None, "limiter": None}  # Shared by every send_sms() call
+
+
+def send_sms(message_str, recipients):
     """
-    Output: SMS all numbers found in self-service DB, via Twilio
+    Output: SMS the given subscribers (contact dicts), via Twilio. Sends through
+    one pooled client on a bounded worker pool, paced to TWILIO_MPS. Returns a
+    list of per-recipient results: {"number", "sid", "error"}
     """
 
     if (
@@ -123,245 +336,467 @@ def send_sms(message_str):
         or "TWILIO_AUTH_TOKEN" not in secrets
         or "TWILIO_NUMBER" not in secrets
     ):
-        logger.error("A required var is not set in .env! Cannot send Telegram message")
+        logger.error("A required var is not set in .env! Cannot send SMS message")
         return False
 
-    recipients = db_contacts.search(tinydb.Query().alert_level == "all")
+    # pylint: disable=import-outside-toplevel
+    import requests
+    from twilio.base.exceptions import TwilioException
 
-    for recipient in recipients:
-        client = Client(secrets["TWILIO_SID"], secrets["TWILIO_AUTH_TOKEN"])
+    if sms["client"] is None:
+        from twilio.rest import Client
 
-        message = client.messages.create(
-            body=message_str, from_=secrets["TWILIO_NUMBER"], to=recipient["number"]
-        )
+        sms["client"] = Client(secrets["TWILIO_SID"], secrets["TWILIO_AUTH_TOKEN"])
+        if config["twilio_api_url"]:  # EG: a local stand-in, see .development/
+            sms["client"].api.base_url = config["twilio_api_url"]
+        sms["limiter"] = TokenBucket(config["twilio_mps"])
+
+    def send_one(recipient):
+        sms["limiter"].take()
+
+        try:
+            message = sms["client"].messages.create(
+                body=message_str, from_=secrets["TWILIO_NUMBER"], to=recipient["number"]
+            )
+        except (TwilioException, requests.exceptions.RequestException) as error:
+            logger.error("Twilio SMS to %s failed: %s", recipient["number"], error)
+            return {"number": recipient["number"], "sid": None, "error": str(error)}
 
         logger.debug("Twilio SMS send: %s", message.sid)
+        return {"number": recipient["number"], "sid": message.sid, "error": None}
 
-    return True
+    with ThreadPoolExecutor(max_workers=config["sms_workers"]) as executor:
+        results = list(executor.map(send_one, recipients))
+
+    logger.debug(
+        "Twilio SMS sent to %s of %s recipients",
+        len([result for result in results if result["error"] is None]),
+        len(results),
+    )
+
+    return results
 
 
 # ------------------------------------------------------------------------------
 
 
-def send_telegram(message_str, priority_str):
+class TelegramClient:
     """
-    Output: Telegram Channel
+    Sends Bot API messages as POST bodies over one pooled session. Each chat
+    has its own token bucket, and HTTP 429 retry_after is honoured
     """
-    chat_id = secrets["TELEGRAM_CHAT_ID"]
 
-    message_str = utf8_encode(message_str)
-    url = (
-        "https://api.telegram.org/"
-        + secrets["TELEGRAM_BOT_ID"]
-        + ":"
-        + secrets["TELEGRAM_BOT_SECRET"]
-        + "/sendMessage?chat_id="
-        + chat_id
-        + "&text="
-        + message_str
-        + "&parse_mode=html&disable_web_page_preview=true"
-    )
+    def __init__(self, bot_id, bot_secret, per_minute, api_url="https://api.telegram.org"):
+        import requests  # pylint: disable=import-outside-toplevel
 
-    if priority_str == "low":
-        url = url + "&disable_notification=true"
+        self.url = api_url + "/" + bot_id + ":" + bot_secret
+        self.per_minute = per_minute
+        self.session = requests.Session()
+        self.buckets = {}
+        self.lock = threading.Lock()
 
-    logger.debug("Telegram URL: %s", url)
+    def bucket(self, chat_id):
+        """
+        Returns the chat's token bucket, allowing short bursts of 3
+        """
+        with self.lock:
+            if chat_id not in self.buckets:
+                self.buckets[chat_id] = TokenBucket(self.per_minute / 60, 3)
+            return self.buckets[chat_id]
 
-    if "False" in [secrets["TELEGRAM_BOT_ID"], secrets["TELEGRAM_BOT_SECRET"], chat_id]:
-        logger.error("A required var is not set in .env! Cannot send Telegram message")
-        return False
+    def send_message(self, chat_id, text, disable_notification=False, tries=3):
+        """
+        Sends one message, waiting out up to `tries` 429s. Returns the
+        requests.Response of the last attempt
+        """
+        payload = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": "html",
+            "disable_web_page_preview": True,
+            "disable_notification": disable_notification,
+        }
 
-    return requests.get(url, timeout=10, allow_redirects=False)
+        for _ in range(tries):
+            self.bucket(chat_id).take()
+            response = self.session.post(self.url + "/sendMessage", json=payload, timeout=10)
 
+            if response.status_code != 429:
+                break
 
-# ------------------------------------------------------------------------------
+            retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+            logger.debug("Telegram 429 for %s, retry after %ss", chat_id, retry_after)
+            self.bucket(chat_id).pause(retry_after)
+
+        return response
+
+
+telegram = {"client": None}  # Shared by every send_telegram() call
 
 
-def process_wildcad():
+def send_telegram(message_str, priority_str, chat_ids=None):
     """
-    Data source: Wildcad
+    Output: Telegram Channel(s). Sends to every TELEGRAM_CHAT_ID (or just the
+    given chat_ids) concurrently. Returns a list of per-chat results:
+    {"chat_id", "message_id", "error"}
     """
-    if MOCK_DATA:
-        if secrets["WILDWEB_E"]:
-            with open(config["wildcad_url"], "r", encoding="utf-8") as file:
-                page = file.read()
-        else:
-            with open(config["wildcad_url"], "r", encoding="utf-8") as file:
-                page = file.read()
-    else:
-        try:
-            page = requests.get(config["wildcad_url"])
-        except requests.exceptions.RequestException as error:
-            logger.error("Could not reach Wildcad URL %s", config["wildcad_url"])
-            logger.error(error)
-            sys.exit(1)
+    if chat_ids is None:
+        chat_ids = config["telegram_chat_ids"]
 
-        if secrets["WILDWEB_E"] is False and (
-            page.content == "" or int(page.headers["Content-Length"]) == 0
-        ):
-            logger.error("Wildcad payload empty %s", config["wildcad_url"])
-            sys.exit(1)
-        elif page.content == "":  # WildWeb-E = just confirm valid body
-            logger.error("Wildcad payload empty %s", config["wildcad_url"])
-            sys.exit(1)
-        else:
-            page = page.content
-
-            if (
-                secrets["WILDWEB_E"]
-                and secrets.get("STORE_RAW_CAD") == "True"
-            ):
-                raw_path = (
-                    "/tmp/wildcad_" + secrets["NF_IDENTIFIER"] + "_raw.json"
-                )
-                with open(raw_path, "wb") as raw_file:
-                    raw_file.write(page)
-                logger.debug("Stored raw CAD JSON at %s", raw_path)
+    bot_id = secrets.get("TELEGRAM_BOT_ID", "False")
+    bot_secret = secrets.get("TELEGRAM_BOT_SECRET", "False")
 
-    checked_ids = []
-    counter = 0
-    data = []
-    inci_list = []
+    if "False" in [bot_id, bot_secret] + chat_ids or not chat_ids:
+        logger.error("A required var is not set in .env! Cannot send Telegram message")
+        return False
 
-    if secrets["WILDWEB_E"] is False:  # WildWeb uses HTML tables
-        tree = html.fromstring(page)
-        rows = tree.xpath("//tr")
-        for row in rows:
-            data.append([c.text_content() for c in row.getchildren()])
-    else:  # WildWeb-E uses JSON
-        for row in json.loads(page)[0]["data"]:
-            data.append(row)
-
-    for item in data:
-        counter = counter + 1
-        if secrets["WILDWEB_E"]:
-            this_fiscal_data = json.loads(item["fiscal_data"])
+    import requests  # pylint: disable=import-outside-toplevel
 
-            if this_fiscal_data["wfdssunit"] is None:
-                this_fiscal_data["wfdssunit"] = "N/A"
+    if telegram["client"] is None:
+        telegram["client"] = TelegramClient(
+            bot_id,
+            bot_secret,
+            config["telegram_per_minute"],
+            config["telegram_api_url"],
+        )
 
-            item_dict = {
-                "time_created": empty_fill(item["date"]),  # "date" field
-                "id": empty_fill(
-                    this_fiscal_data["wfdssunit"] + "-" + this_fiscal_data["inc_num"]
-                ),  # Modified "inc_num" field
-                "name": empty_fill(item["name"]),  # "name" field
-                "type": empty_fill(item["type"]),  # "type" field
-                "comment": empty_fill(item["webComment"]),  # "webComment" field
-                "acres": empty_fill(item["acres"]),  # "acres" field
-                "resources": empty_fill(""),
+    def send_one(chat_id):
+        logger.debug("Telegram send to %s, %s chars", chat_id, len(message_str))
+
+        try:
+            response = telegram["client"].send_message(
+                chat_id, message_str, disable_notification=priority_str == "low"
+            )
+        except requests.exceptions.RequestException as error:
+            error_str = str(error).replace(telegram["client"].url, "<bot>")
+            logger.error("Telegram send to %s failed: %s", chat_id, error_str)
+            return {"chat_id": chat_id, "message_id": None, "error": error_str}
+
+        if response.status_code != 200:
+            logger.error(
+                "Telegram send to %s failed: HTTP %s", chat_id, response.status_code
+            )
+            return {
+                "chat_id": chat_id,
+                "message_id": None,
+                "error": "HTTP " + str(response.status_code),
             }
 
-            if isinstance(item["resources"], list):  # "resources" field
-                if len(item["resources"]) > 0 and item["resources"][0] is not None:
-                    item_dict["resources"] = " ".join(item["resources"])
+        message_id = response.json()["result"]["message_id"]
+        return {"chat_id": chat_id, "message_id": message_id, "error": None}
 
-            if item["latitude"] and item["longitude"]:  # Item has geo data
-                item_dict["x"] = "-" + item["longitude"]
-                item_dict["y"] = item["latitude"]
+    with ThreadPoolExecutor(max_workers=len(chat_ids)) as executor:
+        return list(executor.map(send_one, chat_ids))
 
-            inci_list.append(item_dict)
-        else:
-            if counter > 2 and item[1] not in checked_ids:  # Skip header rows
-                item_date = item[0].split("/")
-                item_date_split = item_date[2].split(" ")
-                item_date[2] = item_date_split[0]
-                item_date.append(item_date_split[1])
-                checked_ids.append(item[1])
-
-                item_dict = {
-                    "time_created": empty_fill(item[0]),  # "Date" field
-                    "id": empty_fill(item[1]),  # "Inc #" field
-                    "name": empty_fill(item[2]),  # "Name" field
-                    "type": empty_fill(item[3]),  # "Type" field
-                    "location": empty_fill(item[4]),  # "Location" field
-                    "comment": empty_fill(item[5]),  # "WebComment" field
-                    "resources": empty_fill(item[6]),  # "Resources" field
-                    "acres": empty_fill(item[8]),  # "Acres" field
-                }
 
-                if ", " in item[9]:  # Item has geo data
-                    item_xy_split = item[9].split(", ")
-                    item_dict["y"] = item_xy_split[0]
-                    item_dict["x"] = item_xy_split[1]
+# ------------------------------------------------------------------------------
 
-                inci_list.append(item_dict)
 
-    return inci_list
+class WildcadError(Exception):
+    """
+    Raised when the WildCAD feed could not be fetched, or came back empty
+    """
 
 
 # ------------------------------------------------------------------------------
 
 
-def pad_date_prop(input_int):
+async def fetch_wildcad(session, this_forest):
     """
-    Pads a given int. EG: 7 becomes 07
+    Downloads (or reads, with mock) the raw WildCAD payload for one forest.
+    Returns None when the feed has not changed since the last processed payload
+    (HTTP 304, or an identical body)
     """
-    return str(f"{input_int:02}")
+    if MOCK_DATA:  # Always reprocess, so edits to the DB can be tested
+        with open(this_forest["wildcad_url"], "r", encoding="utf-8") as file:
+            return file.read()
+
+    import aiohttp  # pylint: disable=import-outside-toplevel
+
+    fetch_state = this_forest["fetch_state"]
+    headers = {}
+
+    if fetch_state.get("etag"):
+        headers["If-None-Match"] = fetch_state["etag"]
+    if fetch_state.get("last_modified"):
+        headers["If-Modified-Since"] = fetch_state["last_modified"]
+
+    nf_identifier = this_forest["nf_identifier"]
+
+    try:
+        with metrics.timer("fetch", forest=nf_identifier):
+            async with session.get(
+                this_forest["wildcad_url"], headers=headers
+            ) as response:
+                if response.status == 304:
+                    logger.debug("%s not modified", nf_identifier)
+                    metrics.count("fetches", forest=nf_identifier, result="not_modified")
+                    return None
+
+                if response.status >= 400:
+                    logger.error(
+                        "Wildcad URL %s returned HTTP %s",
+                        this_forest["wildcad_url"],
+                        response.status,
+                    )
+                    metrics.count("fetches", forest=nf_identifier, result="error")
+                    raise WildcadError(this_forest["wildcad_url"])
+
+                page = await response.read()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        logger.error("Could not reach Wildcad URL %s", this_forest["wildcad_url"])
+        logger.error(error)
+        metrics.count("fetches", forest=nf_identifier, result="error")
+        raise WildcadError(this_forest["wildcad_url"]) from error
+
+    metrics.count("fetch_bytes", len(page), forest=nf_identifier)
+
+    if not page:
+        logger.error("Wildcad payload empty %s", this_forest["wildcad_url"])
+        metrics.count("fetches", forest=nf_identifier, result="error")
+        raise WildcadError(this_forest["wildcad_url"])
+
+    digest = hashlib.sha256(page).hexdigest()
+
+    # Only committed by save_fetch_state() once the payload has been processed
+    this_forest["pending_fetch_state"] = {
+        "etag": etag,
+        "last_modified": last_modified,
+        "digest": digest,
+    }
+
+    if digest == fetch_state.get("digest"):
+        logger.debug("%s payload unchanged", nf_identifier)
+        metrics.count("fetches", forest=nf_identifier, result="unchanged")
+        save_fetch_state(this_forest)  # Validators may still have changed
+        return None
+
+    metrics.count("fetches", forest=nf_identifier, result="changed")
+
+    if raw_archive is not None:
+        try:
+            if raw_archive.add(nf_identifier, page, this_forest["wildweb_e"]):
+                logger.debug("Archived raw CAD payload for %s", nf_identifier)
+        except OSError as error:  # Never let the archive break a poll
+            logger.error("Could not archive raw CAD payload: %s", error)
+
+    return page
 
 
 # ------------------------------------------------------------------------------
 
 
-def get_date():
+def save_fetch_state(this_forest):
     """
-    Returns a MM/DD/YYYY string, with padding/fill, EG: 08/01/2022
+    Remembers the validators and digest of the payload just processed, so the
+    next poll can skip it if nothing changed
     """
-    now = datetime.datetime.now()
-    return str(
-        pad_date_prop(now.month) + "/" + pad_date_prop(now.day) + "/" + str(now.year)
-    )
+    pending_fetch_state = this_forest.pop("pending_fetch_state", None)
+
+    if pending_fetch_state is None or pending_fetch_state == this_forest["fetch_state"]:
+        return
+
+    this_forest["fetch_state"] = pending_fetch_state
+    store.set_fetch_state(this_forest["nf_identifier"], pending_fetch_state)
 
 
 # ------------------------------------------------------------------------------
 
 
-def empty_fill(input_str):
+class WildwebRowTarget:
     """
-    Returns an empty string when given a useless string, to maintain one-per-line
-    formatting in notification messages
+    lxml parser target that collects the text of each table row's cells as the
+    HTML streams in, without ever building a DOM
     """
-    if input_str:
-        if len(input_str) < 1 or input_str == ".":
-            return ""
-    else:
-        return ""
 
-    return str(input_str)
+    def __init__(self):
+        self.rows = []
+        self._row = None
+        self._cell = None
+
+    def start(self, tag, attrib):  # pylint: disable=unused-argument
+        """
+        Opening tag: begin a new row or cell
+        """
+        if tag == "tr":
+            self._row = []
+        elif tag in ("td", "th") and self._row is not None:
+            self._cell = []
+
+    def end(self, tag):
+        """
+        Closing tag: finish the current cell or row
+        """
+        if tag in ("td", "th") and self._cell is not None:
+            self._row.append("".join(self._cell))
+            self._cell = None
+        elif tag == "tr" and self._row is not None:
+            self.rows.append(self._row)
+            self._row = None
+
+    def data(self, data):
+        """
+        Text, which is only kept when inside a cell
+        """
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def close(self):
+        """
+        End of document
+        """
+        return self.rows
+
+
+def iter_wildweb_rows(chunks):
+    """
+    Yields each WildWeb table row as a list of cell strings. Accepts any
+    iterable of str/bytes chunks (EG: a chunked HTTP body), emitting rows as
+    soon as they are complete
+    """
+    from lxml import etree  # pylint: disable=import-outside-toplevel
+
+    target = WildwebRowTarget()
+    parser = etree.HTMLParser(target=target)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from target.rows
+        target.rows = []
+
+    parser.close()
+    yield from target.rows
 
 
 # ------------------------------------------------------------------------------
 
 
-def event_has_changed(inci_dict, inci_db_entry_dict):
+# Raw WildWeb-E keys that process_wildcad() reads, and so the fingerprint covers
+WWE_FINGERPRINT_KEYS = (
+    "date",
+    "fiscal_data",
+    "name",
+    "type",
+    "webComment",
+    "acres",
+    "resources",
+    "latitude",
+    "longitude",
+)
+
+
+def fingerprint(raw_str):
     """
-    Given a new and stored event dict, determines if any values have changed,
-    returning a list of dicts
+    Short, stable hash of a raw feed record
     """
-    inci_db_entry_dict = inci_db_entry_dict[0]
-    changed = []
+    return hashlib.blake2b(raw_str.encode("utf-8"), digest_size=8).hexdigest()
 
-    for key in inci_dict:
-        if (
-            key in inci_db_entry_dict
-            and inci_dict[key] != inci_db_entry_dict[key]
-            and key != "acres"  # Newly-tracked field. Don't notify, just store
-            and key != "time_created"  # No sense in notifying on this one
-        ):
-            changed.append(
-                {"name": key, "new": inci_dict[key], "old": inci_db_entry_dict[key]}
+
+def process_wildcad(page, fingerprints=None):
+    """
+    Data source: Wildcad. Parses a payload from fetch_wildcad() for the current
+    forest. Each record is fingerprinted first, and only decoded into an
+    Incident if its fingerprint differs from the one in `fingerprints` (ID ->
+    fingerprint). Returns (new/changed Incidents, every incident ID in the feed)
+    """
+    fingerprints = fingerprints or {}
+    seen_ids = set()
+    feed_ids = []
+    inci_list = []
+
+    if forest["wildweb_e"]:  # WildWeb-E uses JSON
+        for item in json.loads(page)[0]["data"]:
+            this_fiscal_data = json.loads(item["fiscal_data"])
+
+            if this_fiscal_data["wfdssunit"] is None:
+                this_fiscal_data["wfdssunit"] = "N/A"
+
+            inci_id = empty_fill(
+                this_fiscal_data["wfdssunit"] + "-" + this_fiscal_data["inc_num"]
+            )  # Modified "inc_num" field
+            feed_ids.append(inci_id)
+            item_fingerprint = fingerprint(
+                json.dumps([item.get(key) for key in WWE_FINGERPRINT_KEYS])
             )
 
-    if changed:
-        return changed
+            if fingerprints.get(inci_id) == item_fingerprint:
+                continue
+
+            inci = Incident(
+                time_created=empty_fill(item["date"]),  # "date" field
+                id=inci_id,
+                name=empty_fill(item["name"]),  # "name" field
+                type=empty_fill(item["type"]),  # "type" field
+                comment=empty_fill(item["webComment"]),  # "webComment" field
+                acres=empty_fill(item["acres"]),  # "acres" field
+                resources=empty_fill(""),
+                fingerprint=item_fingerprint,
+            )
 
-    return False
+            if isinstance(item["resources"], list):  # "resources" field
+                if len(item["resources"]) > 0 and item["resources"][0] is not None:
+                    inci.resources = " ".join(item["resources"])
+
+            if item["latitude"] and item["longitude"]:  # Item has geo data
+                inci.x = "-" + item["longitude"]
+                inci.y = item["latitude"]
+
+            inci_list.append(inci)
+    else:  # WildWeb uses HTML tables
+        for counter, item in enumerate(iter_wildweb_rows([page]), 1):
+            if counter > 2 and item[1] not in seen_ids:  # Skip header rows
+                seen_ids.add(item[1])
+                feed_ids.append(empty_fill(item[1]))
+                item_fingerprint = fingerprint("\x1f".join(item))
+
+                if fingerprints.get(empty_fill(item[1])) == item_fingerprint:
+                    continue
+
+                inci = Incident(
+                    time_created=empty_fill(item[0]),  # "Date" field
+                    id=empty_fill(item[1]),  # "Inc #" field
+                    name=empty_fill(item[2]),  # "Name" field
+                    type=empty_fill(item[3]),  # "Type" field
+                    location=empty_fill(item[4]),  # "Location" field
+                    comment=empty_fill(item[5]),  # "WebComment" field
+                    resources=empty_fill(item[6]),  # "Resources" field
+                    acres=empty_fill(item[8]),  # "Acres" field
+                    fingerprint=item_fingerprint,
+                )
+
+                if ", " in item[9]:  # Item has geo data
+                    item_xy_split = item[9].split(", ")
+                    inci.y = item_xy_split[0]
+                    inci.x = item_xy_split[1]
+
+                inci_list.append(inci)
+
+    return inci_list, feed_ids
+
+
+# ------------------------------------------------------------------------------
+
+
+def empty_fill(input_str):
+    """
+    Returns an empty string when given a useless string, to maintain one-per-line
+    formatting in notification messages
+    """
+    if input_str:
+        if len(input_str) < 1 or input_str == ".":
+            return ""
+    else:
+        return ""
+
+    return str(input_str)
 
 
 # ------------------------------------------------------------------------------
 
 
-def is_fire(inci_dict):
+def is_fire(inci):
     """
     Simple algo determines whether the given incident matches our criteria for
     a fire incident
@@ -369,21 +804,31 @@ def is_fire(inci_dict):
     ignore_list = ["DAILY STATUS", "MEDICAL AID"]
 
     if (
-        "FIRE" in inci_dict["type"].strip().upper()
-        or "FIRE" in inci_dict["name"].strip().upper()
-        or "SMOKE" in inci_dict["name"].strip().upper()
-        or "SMOKE" in inci_dict["type"].strip().upper()
-        or "COMPLEX" in inci_dict["name"].strip().upper()
-        or "COMPLEX" in inci_dict["type"].strip().upper()
+        "FIRE" in inci.type.strip().upper()
+        or "FIRE" in inci.name.strip().upper()
+        or "SMOKE" in inci.name.strip().upper()
+        or "SMOKE" in inci.type.strip().upper()
+        or "COMPLEX" in inci.name.strip().upper()
+        or "COMPLEX" in inci.type.strip().upper()
     ) and (
-        inci_dict["type"].strip().upper() not in ignore_list
-        and inci_dict["name"].strip().upper() not in ignore_list
+        inci.type.strip().upper() not in ignore_list
+        and inci.name.strip().upper() not in ignore_list
     ):
         return True
 
     return False
 
 
+def is_growing(inci, stored_inci):
+    """
+    Whether a fire's feed record shows it growing since we stored it: more
+    acres, or more resources assigned
+    """
+    return parse_acres(inci.acres) > parse_acres(stored_inci.acres) or len(
+        resource_set(inci.resources)
+    ) > len(resource_set(stored_inci.resources))
+
+
 # ------------------------------------------------------------------------------
 
 
@@ -391,20 +836,18 @@ def process_major_alerts():
     """
     If major incident, flag it as such (for analytics and future use)
     """
-    inci_db = tinydb.Query()
-
-    for inci in db.all():
+    for inci in forest["incidents"].all():
         if (
-            inci["name"] != "New"
-            and secrets["NF_IDENTIFIER"] + "-" in inci["id"]
-            and "resources" in inci
-            and inci["resources"].strip() != ""
-            and "flag_major" not in inci
+            inci.name != "New"
+            and forest["nf_identifier"] + "-" in inci.id
+            and inci.resources is not None
+            and inci.resources.strip() != ""
+            and inci.flag_major is None
         ):
-            logger.debug("New Major event detected: %s", inci["id"])
+            logger.debug("New Major event detected: %s", inci.id)
 
-            inci["flag_major"] = True
-            db.update(inci, inci_db.id == inci["id"])
+            inci.flag_major = True
+            forest["incidents"].save(inci)
 
     return True
 
@@ -412,60 +855,151 @@ def process_major_alerts():
 # ------------------------------------------------------------------------------
 
 
-def generate_plain_initial_notif_body(inci_dict):
+# Notification templates, formatted with the values from incident_fields() and
+# incident_geo(). Plain bodies carry short links, rich bodies carry full ones
+FIELDS_TEMPLATE = (
+    "\nID: {id}"
+    "\nName: {name}"
+    "\nType: {type}"
+    "\nCreated: {created}"
+    "\nComment: {comment}"
+    "\nAcres: {acres}"
+    "\nResources: {resources}"
+)
+
+PLAIN_INITIAL_TOOLS_TEMPLATE = (
+    "\nTools:"
+    "\n- Google: {google}"
+    "\n- Apple: {apple}"
+    "\n- Waze: {waze}"
+    "\n- ADS-B: {adsbex}"
+    "\n- LL, DDM: {x},{y}"
+    "\n- LL, DD: {dd_x},{dd_y}"
+    "\n- Nearby Cams: {cameras}"
+)
+
+PLAIN_DIFF_TOOLS_TEMPLATE = (
+    "\nTools (Revised):"
+    "\n- Google: {google}"
+    "\n- Apple: {apple}"
+    "\n- Waze: {waze}"
+    "\n- ADSB-Ex.: {adsbex}"
+    "\n- Lat/Long (DDM): {x}, {y}"
+    "\n- Lat/Long (DD):    {dd_x}, {dd_y}"
+    "\n- Nearby Cams: {cameras}"
+)
+
+RICH_CAMERAS_TEMPLATE = '\n• <a href="{cameras}">ALERTCalifornia Webcams</a>'
+
+RICH_GEO_TEMPLATE = (
+    "\n• Lat/Long (DDM): {y}, {x}"
+    "\n• Lat/Long (DD):    {dd_y}, {dd_x}"
+    '\n• Maps: <a href="{google}">Google</a>'
+    ' - <a href="{apple}">Apple</a>'
+    ' - <a href="{waze}">Waze</a>'
+    ' - <a href="{adsbex}">ADS-B Ex.</a>'
+)
+
+BROADCASTIFY_TEMPLATE = (
+    '\n• <a href="https://www.broadcastify.com/listen/feed/{}">Broadcastify Stream</a>'
+)
+
+MAP_LINKS = ("google", "apple", "waze", "adsbex", "cameras")  # Shortening order
+
+
+# ------------------------------------------------------------------------------
+
+
+def incident_fields(inci):
+    """
+    Returns the display values shared by the initial notification bodies
+    """
+    return {
+        "id": empty_fill(inci.id),
+        "name": empty_fill(inci.name),
+        "type": empty_fill(inci.type),
+        "created": empty_fill(relative_time(inci.time_created)),
+        "comment": empty_fill(inci.comment),
+        "acres": empty_fill(inci.acres),
+        "resources": empty_fill(inci.resources),
+    }
+
+
+# ------------------------------------------------------------------------------
+
+
+@functools.lru_cache(maxsize=1024)
+def build_geo(x_str, y_str, inci_id, wildweb_e):
+    """
+    Decimal coordinates and map URLs for one incident location. Cached, so each
+    revision's coordinates are converted once no matter how many bodies use them
+    """
+    dd_x = str(gps_to_decimal(x_str, wildweb_e))
+    dd_y = str(gps_to_decimal(y_str, wildweb_e))
+
+    return {
+        "x": str(x_str),
+        "y": str(y_str),
+        "dd_x": dd_x,
+        "dd_y": dd_y,
+        "google": "https://www.google.com/maps/search/" + dd_y + "," + dd_x + "?sa=X",
+        "apple": "http://maps.apple.com/?ll=" + dd_y + "," + dd_x + "&q=" + inci_id,
+        "waze": "https://www.waze.com/ul?ll=" + dd_y + "%2C" + dd_x,
+        "adsbex": "https://globe.adsbexchange.com/?lat="
+        + dd_y
+        + "&lon="
+        + dd_x
+        + "&zoom=11.5"
+        + inci_id,
+        "cameras": "https://cameras.alertcalifornia.org/?pos="
+        + str(y_str)
+        + "_"
+        + str(x_str)
+        + "_11",
+    }
+
+
+def incident_geo(inci):
+    """
+    Returns the incident's geo values (see build_geo), or None if it has no
+    coordinates
+    """
+    if not inci.has_geo:
+        return None
+
+    return build_geo(inci.x, inci.y, inci.id, forest["wildweb_e"])
+
+
+def short_geo(geo):
+    """
+    Returns a copy of the geo values with the map links shortened, for SMS
+    """
+    return {
+        **geo,
+        **{link: shorten_url(geo[link]) for link in MAP_LINKS},
+    }
+
+
+# ------------------------------------------------------------------------------
+
+
+def generate_plain_initial_notif_body(inci):
     """
     Returns a string usually passed into send_sms() with a prepared message
     """
     notif_body = (
-        secrets["NF_IDENTIFIER"]
+        forest["nf_identifier"]
         + " Poss. Fire:"
-        + "\nID: "
-        + empty_fill(inci_dict["id"])
-        + "\nName: "
-        + empty_fill(inci_dict["name"])
-        + "\nType: "
-        + empty_fill(inci_dict["type"])
-        + "\nCreated: "
-        + empty_fill(relative_time(inci_dict["time_created"]))
-        + "\nComment: "
-        + empty_fill(inci_dict["comment"])
-        + "\nAcres: "
-        + empty_fill(inci_dict["acres"])
-        + "\nResources: "
-        + empty_fill(inci_dict["resources"])
+        + FIELDS_TEMPLATE.format(**incident_fields(inci))
     )
 
-    if secrets["WILDWEB_E"] == False:  # Only WildWeb has this field
-        notif_body += "\nLocation: " + empty_fill(inci_dict["location"])
-
-    if "x" in inci_dict and "y" in inci_dict:
-        notif_body += (
-            "\nTools:"
-            + "\n- Google: "
-            + create_google_maps_url(inci_dict, False)
-            + "\n- Apple: "
-            + create_applemaps_url(inci_dict, False)
-            + "\n- Waze: "
-            + create_waze_url(inci_dict, False)
-            + "\n- ADS-B: "
-            + create_adsbex_url(inci_dict, False)
-        )
-
-        notif_body += (
-            "\n- LL, DDM: "
-            + empty_fill(str(inci_dict["x"]) + "," + str(inci_dict["y"]))
-            + "\n- LL, DD: "
-            + empty_fill(
-                str(convert_gps_to_decimal(inci_dict["x"]))
-                + ","
-                + str(convert_gps_to_decimal(inci_dict["y"]))
-            )
-        )
+    if forest["wildweb_e"] is False:  # Only WildWeb has this field
+        notif_body += "\nLocation: " + empty_fill(inci.location)
 
-        nearby_cameras = nearby_cameras_url(inci_dict)
+    geo = incident_geo(inci)
 
-        if nearby_cameras:
-            notif_body += "\n- Nearby Cams: " + shorten_url(nearby_cameras)
+    if geo:
+        notif_body += PLAIN_INITIAL_TOOLS_TEMPLATE.format(**short_geo(geo))
 
     return notif_body
 
@@ -473,138 +1007,82 @@ def generate_plain_initial_notif_body(inci_dict):
 # ------------------------------------------------------------------------------
 
 
-def generate_plain_diff_body(inci_dict, event_changes):
+def generate_plain_diff_body(inci, event_changes):
     """
     Generates an incident change notification, plaintext version
     """
     send_maps_link = False
 
-    notif_body = inci_dict["id"] + " Changed:\n"
+    notif_body = inci.id + " Changed:\n"
 
     for change in event_changes:
         notif_body += "--\n"
-        notif_body += change["name"].upper() + "\n"
-        notif_body += "Old: " + change["old"] + "\n"
-        notif_body += "New: " + change["new"] + "\n"
+        notif_body += change.name.upper() + "\n"
+        notif_body += "Old: " + change.old + "\n"
+        notif_body += "New: " + change.new + "\n"
 
-        if change["name"] == "x" or change["name"] == "y":
+        if change.name == "x" or change.name == "y":
             send_maps_link = True
 
     if send_maps_link is True:
-        notif_body += (
-            "\nTools (Revised):"
-            + "\n- Google: "
-            + create_google_maps_url(inci_dict, False)
-            + "\n- Apple: "
-            + create_applemaps_url(inci_dict, False)
-            + "\n- Waze: "
-            + create_waze_url(inci_dict, False)
-            + "\n- ADSB-Ex.: "
-            + create_adsbex_url(inci_dict, False)
-        )
-
-        notif_body += (
-            "\n- Lat/Long (DDM): "
-            + empty_fill(str(inci_dict["x"]) + ", " + str(inci_dict["y"]))
-            + "\n- Lat/Long (DD):    "
-            + empty_fill(
-                str(convert_gps_to_decimal(inci_dict["x"]))
-                + ", "
-                + str(convert_gps_to_decimal(inci_dict["y"]))
-            )
+        notif_body += PLAIN_DIFF_TOOLS_TEMPLATE.format(
+            **short_geo(incident_geo(inci))
         )
 
-        nearby_cameras = nearby_cameras_url(inci_dict)
-
-        if nearby_cameras:
-            notif_body += "\n- Nearby Cams: " + shorten_url(nearby_cameras)
-
     return notif_body
 
 
 # ------------------------------------------------------------------------------
 
 
-def generate_rich_diff_body(inci_dict, inci_db_entry, event_changes):
+def generate_rich_diff_body(inci, stored_inci, event_changes):
     """
     Generates an incident change notification, nice HTML version
     """
     send_maps_link = False
 
-    if "TELEGRAM_CHAT_ID" in secrets and "original_message_id" in inci_db_entry[0]:
-        if "@" in secrets["TELEGRAM_CHAT_ID"]:
-            telegram_chat_id_stripped = secrets["TELEGRAM_CHAT_ID"].replace("@", "")
+    if config["telegram_chat_ids"] and stored_inci.original_message_id is not None:
+        if "@" in config["telegram_chat_ids"][0]:
+            telegram_chat_id_stripped = config["telegram_chat_ids"][0].replace("@", "")
         else:
-            telegram_chat_id_stripped = secrets["TELEGRAM_CHAT_ID"]
+            telegram_chat_id_stripped = config["telegram_chat_ids"][0]
         notif_body = (
             'Dispatch changed <b><a href="https://t.me/'
             + telegram_chat_id_stripped
             + "/"
-            + str(inci_db_entry[0]["original_message_id"])
+            + str(stored_inci.original_message_id)
             + '">'
-            + inci_dict["id"]
+            + inci.id
             + "</a></b>"
         )
     else:
-        notif_body = "Dispatch changed <b>" + inci_dict["id"] + "</b>"
+        notif_body = "Dispatch changed <b>" + inci.id + "</b>"
 
     for change in event_changes:
-        if change["name"] == "resources":
-            notif_body += "\n" + granular_diff_list(inci_dict, inci_db_entry)
+        if isinstance(change, ResourceChange):
+            notif_body += "\n" + granular_diff_list(change)
         else:
             notif_body += (
                 "\n"
-                + uppercase_first(change["name"])
+                + uppercase_first(change.name)
                 + ": "
                 + "<s>"
-                + change["old"]
+                + change.old
                 + "</s> "
-                + change["new"]
+                + change.new
             )
 
-        if change["name"] == "x" or change["name"] == "y":
+        if change.name == "x" or change.name == "y":
             send_maps_link = True
 
     if send_maps_link is True:
-        notif_body += "\nTools:<em>"
-
-        nearby_cameras = nearby_cameras_url(inci_dict)
-
-        if nearby_cameras:
-            notif_body += (
-                '\n• <a href="' + nearby_cameras + '">ALERTCalifornia Webcams</a>'
-            )
+        geo = incident_geo(inci)
+        notif_body += "\nTools:<em>" + RICH_CAMERAS_TEMPLATE.format(**geo)
 
         if "BROADCASTIFY_ID" in secrets:
-            notif_body += (
-                '\n• <a href="https://www.broadcastify.com/listen/feed/'
-                + str(secrets["BROADCASTIFY_ID"])
-                + '">Broadcastify Stream</a>'
-            )
-
-        notif_body += (
-            "\n• Lat/Long (DDM): "
-            + empty_fill(str(inci_dict["y"]) + ", " + str(inci_dict["x"]))
-            + "\n• Lat/Long (DD):    "
-            + empty_fill(
-                str(convert_gps_to_decimal(inci_dict["y"]))
-                + ", "
-                + str(convert_gps_to_decimal(inci_dict["x"]))
-            )
-        )
-
-        notif_body += (
-            "\n• Maps: "
-            + create_google_maps_url(inci_dict, True)
-            + " - "
-            + create_applemaps_url(inci_dict, True)
-            + " - "
-            + create_waze_url(inci_dict, True)
-            + " - "
-            + create_adsbex_url(inci_dict, True)
-        )
+            notif_body += BROADCASTIFY_TEMPLATE.format(secrets["BROADCASTIFY_ID"])
 
-        notif_body += "</em>"
+        notif_body += RICH_GEO_TEMPLATE.format(**geo) + "</em>"
 
     return notif_body
 
@@ -612,72 +1090,29 @@ def generate_rich_diff_body(inci_dict, inci_db_entry, event_changes):
 # ------------------------------------------------------------------------------
 
 
-def generate_notif_body(inci_dict):
+def generate_notif_body(inci):
     """
     Returns a string usually passed into send_telegram() with a prepared message
     """
     notify_title = "New Possible Fire Incident"
 
     notif_body = (
-        "<b>"
-        + notify_title
-        + "</b>"
-        + "\nID: "
-        + empty_fill(inci_dict["id"])
-        + "\nName: "
-        + empty_fill(inci_dict["name"])
-        + "\nType: "
-        + empty_fill(inci_dict["type"])
-        + "\nCreated: "
-        + empty_fill(relative_time(inci_dict["time_created"]))
-        + "\nComment: "
-        + empty_fill(inci_dict["comment"])
-        + "\nAcres: "
-        + empty_fill(inci_dict["acres"])
-        + "\nResources: "
-        + empty_fill(inci_dict["resources"])
+        "<b>" + notify_title + "</b>" + FIELDS_TEMPLATE.format(**incident_fields(inci))
     )
 
-    if "location" in inci_dict:
-        notif_body += "\nLocation: " + empty_fill(inci_dict["location"])
+    if inci.location is not None:
+        notif_body += "\nLocation: " + empty_fill(inci.location)
 
     notif_body += "\nTools:<em>"
 
     if "BROADCASTIFY_ID" in secrets:
-        notif_body += (
-            '\n• <a href="https://www.broadcastify.com/listen/feed/'
-            + str(secrets["BROADCASTIFY_ID"])
-            + '">Broadcastify Stream</a>'
-        )
+        notif_body += BROADCASTIFY_TEMPLATE.format(secrets["BROADCASTIFY_ID"])
 
-    if "x" in inci_dict and "y" in inci_dict:
-        nearby_cameras = nearby_cameras_url(inci_dict)
+    geo = incident_geo(inci)
 
-        if nearby_cameras:
-            notif_body += (
-                '\n• <a href="' + nearby_cameras + '">ALERTCalifornia Webcams</a>'
-            )
-
-        notif_body += (
-            "\n• Lat/Long (DDM): "
-            + empty_fill(str(inci_dict["y"]) + ", " + str(inci_dict["x"]))
-            + "\n• Lat/Long (DD):    "
-            + empty_fill(
-                str(convert_gps_to_decimal(inci_dict["y"]))
-                + ", "
-                + str(convert_gps_to_decimal(inci_dict["x"]))
-            )
-        )
-
-        notif_body += (
-            "\n• Maps: "
-            + create_google_maps_url(inci_dict, True)
-            + " - "
-            + create_applemaps_url(inci_dict, True)
-            + " - "
-            + create_waze_url(inci_dict, True)
-            + " - "
-            + create_adsbex_url(inci_dict, True)
+    if geo:
+        notif_body += RICH_CAMERAS_TEMPLATE.format(**geo) + RICH_GEO_TEMPLATE.format(
+            **geo
         )
 
     notif_body += "</em>"
@@ -692,7 +1127,7 @@ def relative_time(input_str):
     """
     Parses a date/time like "08/10/2022 16:08" into "Aug 10 '22, 16:08"
     """
-    if secrets["WILDWEB_E"]:
+    if forest["wildweb_e"]:
         if "." in input_str:
             return datetime.datetime.strptime(
                 input_str, "%Y-%m-%dT%H:%M:%S.%f"
@@ -720,133 +1155,25 @@ def uppercase_first(input_str):
 # ------------------------------------------------------------------------------
 
 
-def create_google_maps_url(inci_dict, rich_bool=False):
-    """
-    Returns a Google Maps URL for given X/Y coordinates
-    """
-    url = (
-        "https://www.google.com/maps/search/"
-        + str(convert_gps_to_decimal(inci_dict["y"]))
-        + ","
-        + str(convert_gps_to_decimal(inci_dict["x"]))
-        + "?sa=X"
-    )
-
-    if rich_bool:
-        return '<a href="' + url + '">Google</a>'
-
-    return shorten_url(url)
-
-
-# ------------------------------------------------------------------------------
-
-
-def create_applemaps_url(inci_dict, rich_bool=False):
-    """
-    Returns a Google Maps URL for given X/Y coordinates
-    """
-    url = (
-        "http://maps.apple.com/?ll="
-        + str(convert_gps_to_decimal(inci_dict["y"]))
-        + ","
-        + str(convert_gps_to_decimal(inci_dict["x"]))
-        + "&q="
-        + inci_dict["id"]
-    )
-
-    if rich_bool:
-        return '<a href="' + url + '">Apple</a>'
-
-    return shorten_url(url)
-
-
-# ------------------------------------------------------------------------------
-
-
-def create_adsbex_url(inci_dict, rich_bool=False):
+def granular_diff_list(change):
     """
-    Returns an ADSB Exchange URL for given X/Y coordinates
+    Renders a ResourceChange's additions, removals, and unchanged resources as
+    an HTML formatted string
     """
-    url = (
-        "https://globe.adsbexchange.com/?lat="
-        + str(convert_gps_to_decimal(inci_dict["y"]))
-        + "&lon="
-        + str(convert_gps_to_decimal(inci_dict["x"]))
-        + "&zoom=11.5"
-        + inci_dict["id"]
-    )
-
-    if rich_bool:
-        return '<a href="' + url + '">ADS-B Ex.</a>'
-
-    return shorten_url(url)
-
-
-# ------------------------------------------------------------------------------
-
-
-def create_waze_url(inci_dict, rich_bool=False):
-    """
-    Returns a Waze URL for given X/Y coordinates
-    """
-    url = (
-        "https://www.waze.com/ul?ll="
-        + str(convert_gps_to_decimal(inci_dict["y"]))
-        + "%2C"
-        + str(convert_gps_to_decimal(inci_dict["x"]))
-    )
-
-    if rich_bool:
-        return '<a href="' + url + '">Waze</a>'
-
-    return shorten_url(url)
-
-
-# ------------------------------------------------------------------------------
-
-
-def granular_diff_list(inci_dict, inci_db_dict):
-    """ "
-    Takes in fresh and stored dicts and computes granular diffs (additions,
-    removals, and unchanged). Outputs an HTML formatted string
-    """
-    change_list_added = []
-    change_list_removed = []
-    change_list_unchanged = []
-    resource_list = []
-    inci_db_dict = inci_db_dict[0]
-
-    inci_dict = sorted(inci_dict["resources"].strip().split(" "))
-    inci_db_dict = sorted(inci_db_dict["resources"].strip().split(" "))
-
-    for resource in inci_dict:
-        if resource.strip() != "":
-            resource_list.append(resource.strip())
-
-    for resource in inci_db_dict:
-        if resource not in resource_list and resource.strip() != "":
-            resource_list.append(resource.strip())
-
-    for resource in resource_list:
-        if resource not in inci_db_dict:  # Newly-added resource
-            change_list_added.append(resource.strip())
-        elif resource not in inci_dict:  # Newly-removed resource
-            change_list_removed.append("<s>" + resource.strip() + "</s>")
-        else:  # Unchanged resource
-            change_list_unchanged.append(resource.strip())
-
     output_str = ""
 
-    if len(change_list_added) > 0:
-        output_str += "\n   <em>Added</em>: " + (", ".join(change_list_added))
+    if change.added:
+        output_str += "\n   <em>Added</em>: " + ", ".join(change.added)
 
-    if len(change_list_removed) > 0:
-        output_str += "\n   <em>Removed</em>: " + (", ".join(change_list_removed))
+    if change.removed:
+        output_str += "\n   <em>Removed</em>: " + ", ".join(
+            "<s>" + resource + "</s>" for resource in change.removed
+        )
 
-    if len(change_list_unchanged) > 0:
-        output_str += "\n   <em>No Change</em>: " + (", ".join(change_list_unchanged))
+    if change.unchanged:
+        output_str += "\n   <em>No Change</em>: " + ", ".join(change.unchanged)
 
-    resource_count = len(change_list_added) + len(change_list_unchanged)
+    resource_count = len(change.added) + len(change.unchanged)
 
     return "Resources (" + str(resource_count) + "): " + output_str
 
@@ -854,9 +1181,11 @@ def granular_diff_list(inci_dict, inci_db_dict):
 # ------------------------------------------------------------------------------
 
 
-def convert_gps_to_decimal(input_int):
+@functools.lru_cache(maxsize=4096)
+def gps_to_decimal(input_int, wildweb_e):
     """
-    Converts GPS/DM/DMM to decimal geo-coordinates used by all mapping platforms
+    Converts GPS/DM/DMM to decimal geo-coordinates used by all mapping platforms.
+    WildWeb-E coordinates are already decimal
     """
 
     def format_geo(input_str):
@@ -892,7 +1221,7 @@ def convert_gps_to_decimal(input_int):
 
     # --------------------------------------------------------------------------
 
-    if secrets["WILDWEB_E"]:
+    if wildweb_e:
         return input_int
 
     input_int_formatted = format_geo(input_int)
@@ -911,51 +1240,71 @@ def convert_gps_to_decimal(input_int):
 def process_alerts(inci_list):
     """
     The heart of this script, this compares what we know with what
-    we just got (DB contents vs. fresh WildWeb fetch):
+    we just got (DB contents vs. fresh WildWeb fetch). Only gets the incidents
+    whose fingerprint changed, see process_wildcad():
         - Delete entry if it no longer passes the is_fire() criteria
         - Update entry if any of its properties have changed, sends diff. alert
         - Adds an entry if it is not found in the DB, sends initial alert
+    Alerts are queued in the outbox and sent by the delivery worker
     """
-    if len(inci_list) > 0:
-        inci_db = tinydb.Query()
-    else:
+    if len(inci_list) == 0:
         return False
 
+    incidents = forest["incidents"]
+
     for inci in inci_list:
+        stored_inci = incidents.get(inci.id)
+
+        if stored_inci:
+            logger.debug("%s found in DB", inci.id)
+            event_changes = diff_incidents(inci, stored_inci)
 
-        if db.search(inci_db.id == inci["id"]):
-            logger.debug("%s found in DB", inci["id"])
-            inci_db_entry = db.search(inci_db.id == inci["id"])
-            event_changes = event_has_changed(inci, inci_db_entry)
+            # The daemon polls an active forest more often, see poll_delay()
+            if is_fire(inci) and (event_changes or is_growing(inci, stored_inci)):
+                forest["last_activity"] = time.time()
 
             if event_changes:
-                logger.debug("%s has changed", inci["id"])
+                logger.debug("%s has changed", inci.id)
+
+                metrics.count("changes", forest=forest["nf_identifier"], kind="change")
 
                 # Event changed from type 'Wildfire'. Delete from DB
                 if is_fire(inci) is False:
-                    db.remove(inci_db.id == inci["id"])
-                else:
-                    db.update(inci, inci_db.id == inci["id"])
-
-                send_telegram(
-                    generate_rich_diff_body(inci, inci_db_entry, event_changes), "low"
+                    incidents.remove(inci.id, "not_fire")
+                    forest["ignored_fingerprints"][inci.id] = inci.fingerprint
+                else:  # Keep stored-only fields, EG: original_message_id
+                    incidents.save(inci.merged_over(stored_inci))
+
+                incidents.enqueue(
+                    "telegram",
+                    generate_rich_diff_body(inci, stored_inci, event_changes),
+                    "low",
+                )
+                incidents.enqueue(
+                    "sms", generate_plain_diff_body(inci, event_changes), "low"
                 )
-                send_sms(generate_plain_diff_body(inci, event_changes))
             else:
-                logger.debug("%s unchanged", inci["id"])
+                logger.debug("%s unchanged", inci.id)
+
+                # EG: only acres changed. Store it, and the new fingerprint
+                if inci.fingerprint != stored_inci.fingerprint:
+                    incidents.save(inci.merged_over(stored_inci))
         else:
             if is_fire(inci):  # First time incident is seen, insert into DB
-                logger.debug("%s not found in DB, new inci", inci["id"])
-                db.insert(inci)
-                telegram_json = send_telegram(generate_notif_body(inci), "high")
-
-                # Message sent successfully, store Telegram message ID
-                if telegram_json is not False:
-                    telegram_json = json.loads(telegram_json.content)
-                    inci["original_message_id"] = telegram_json["result"]["message_id"]
-                    db.update(inci, inci_db.id == inci["id"])
-
-                send_sms(generate_plain_initial_notif_body(inci))
+                logger.debug("%s not found in DB, new inci", inci.id)
+                metrics.count("changes", forest=forest["nf_identifier"], kind="new")
+                forest["last_activity"] = time.time()
+                incidents.save(inci)
+
+                # The delivery worker stores the Telegram message ID once sent
+                incidents.enqueue(
+                    "telegram", generate_notif_body(inci), "high", inci.id
+                )
+                incidents.enqueue(
+                    "sms", generate_plain_initial_notif_body(inci), "high", inci.id
+                )
+            else:  # Skip it until its record changes
+                forest["ignored_fingerprints"][inci.id] = inci.fingerprint
 
     return True
 
@@ -963,57 +1312,137 @@ def process_alerts(inci_list):
 # ------------------------------------------------------------------------------
 
 
-def process_daily_recap():
+# Recap kinds, each covering a period that ends at RECAP_TIME on its last day
+RECAP_TITLES = {"day": "Daily Recap", "week": "Weekly Recap", "month": "Monthly Recap"}
+RECAP_CATCH_UP = 7  # Most missed recaps of each kind sent after downtime
+
+
+def next_period(period, start):
     """
-    Send daily recap if time is 23:59
+    Returns the start date of the period after the one starting at `start`
     """
-    date_now = datetime.datetime.now()
+    if period == "day":
+        return start + datetime.timedelta(days=1)
+    if period == "week":
+        return start + datetime.timedelta(days=7)
+    return (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
 
-    if str(date_now.hour) + ":" + str(date_now.minute) == "23:59":
-        logger.debug("Generating daily recap")
-        inci_db = tinydb.Query()
-        results = db.search(inci_db.time_created.search(get_date()))
-        notif_body = "<b>Daily Recap:</b> "
 
-        if results:
-            if len(results) == 1:
-                notif_body = (
-                    notif_body
-                    + "Today there was only <b>1</b> actual"
-                    + " fire incident in "
-                    + secrets["NF_IDENTIFIER"]
-                )
-            else:
-                notif_body = (
-                    notif_body
-                    + "Today there were <b>"
-                    + str(len(results))
-                    + "</b> actual fire incidents in "
-                    + secrets["NF_IDENTIFIER"]
-                )
+def last_due_period(period, now):
+    """
+    Returns the start date of the latest period (days, Monday-Sunday weeks or
+    months) whose recap is due at local datetime `now`
+    """
+    today = now.date()
+    start = store_period_start(period, today)
 
-            send_telegram(notif_body, "low")
+    if (now.hour, now.minute) >= config["recap_time"] and next_period(
+        period, start
+    ) == today + datetime.timedelta(days=1):
+        return start  # Today is the period's last day, and it's recap time
 
-    perform_cleanup(process_wildcad_inci_list)
+    # Otherwise the previous period is the latest one to have ended
+    return store_period_start(period, start - datetime.timedelta(days=1))
 
 
-# ------------------------------------------------------------------------------
+def recap_body(period, start, rollup, current):
+    """
+    Returns a recap's text from its rollup counters, None if there were no
+    fires. `current` is True when it is sent on the period's last day
+    """
+    fire_count = rollup["fires"]
+
+    if not fire_count:
+        return None
+
+    if period == "day":
+        when_str = "Today" if current else "On " + f"{start:%b} {start.day}"
+    elif period == "week":
+        when_str = "This week" if current else "The week of " + f"{start:%b} {start.day}"
+    else:
+        when_str = "This month" if current else "In " + f"{start:%B %Y}"
+
+    notif_body = "<b>" + RECAP_TITLES[period] + ":</b> " + when_str
+
+    if fire_count == 1:
+        notif_body = (
+            notif_body
+            + " there was only <b>1</b> actual"
+            + " fire incident in "
+            + forest["nf_identifier"]
+        )
+    else:
+        notif_body = (
+            notif_body
+            + " there were <b>"
+            + str(fire_count)
+            + "</b> actual fire incidents in "
+            + forest["nf_identifier"]
+        )
+
+    if period != "day":
+        notif_body = (
+            notif_body
+            + ", <b>"
+            + str(rollup["major"])
+            + "</b> major, with <b>"
+            + str(rollup["resources"])
+            + "</b> resources dispatched and <b>"
+            + f"{max(rollup['acres'], 0):,.0f}"
+            + "</b> acres reported"
+        )
+
+    return notif_body
 
 
-def nearby_cameras_url(inci_dict):
+def process_recaps(now=None):
     """
-    When given a dict with lat/long ('x','y') structures an alertcalifornia URL
+    Queues each recap (RECAPS: day, week, month) that has come due for the
+    current forest by local datetime `now` (default: now) since the last one
+    sent, catching up on windows missed while FireBot wasn't running. Each
+    recap reads one rollup row, so its cost doesn't grow with history, and is
+    recorded exactly once, see store.py
     """
-    if "x" in inci_dict and "y" in inci_dict:
-        return (
-            "https://cameras.alertcalifornia.org/?pos="
-            + str(inci_dict["y"])
-            + "_"
-            + str(inci_dict["x"])
-            + "_11"
+    now = datetime.datetime.now() if now is None else now
+
+    for period in config["recaps"]:
+        key = "recap_" + period + "_" + forest["nf_identifier"]
+        due = last_due_period(period, now)
+        last_sent = store.get_meta(key)
+
+        if last_sent is None:  # First run: nothing to catch up on
+            store.record_recap(key, due.isoformat(), None)
+            continue
+
+        starts = []
+        start = next_period(
+            period, store_period_start(period, datetime.date.fromisoformat(last_sent))
         )
 
-    return False
+        while start <= due:
+            starts.append(start)
+            start = next_period(period, start)
+
+        for start in starts[-RECAP_CATCH_UP:]:
+            notif_body = recap_body(
+                period,
+                start,
+                store.get_rollup(forest["nf_identifier"], period, start.isoformat()),
+                next_period(period, start) > now.date(),
+            )
+            message = None
+
+            if notif_body is not None:
+                logger.debug("Generating %s recap for %s", period, start)
+                message = {
+                    "channel": "telegram",
+                    "priority": "low",
+                    "forest": forest["nf_identifier"],
+                    "inci_id": None,
+                    "body": notif_body,
+                }
+
+            store.record_recap(key, start.isoformat(), message)
 
 
 # ------------------------------------------------------------------------------
@@ -1029,82 +1458,490 @@ def shorten_url(url_str):
         logger.debug("URL_SHORT not defined in secrets. Skipping")
         return url_str
 
-    # --------------------------------------------------------------------------
+    short_url_result = short_urls.get_id(url_str)
+
+    return secrets["URL_SHORT"] + "/" + short_url_result
+
 
-    def find_new_id(start=False):
-        new_id_found = False
+# ------------------------------------------------------------------------------
+
+
+def perform_cleanup(feed_ids):
+    """
+    Removes entries no longer present in WildWeb from the live incidents. Their
+    history is kept, see store.py
+    """
+    if feed_ids:
+        removed_ids = forest["incidents"].remove_except(feed_ids)
+        forest["incidents"].see()
+
+        for inci_id in removed_ids:
+            logger.debug("Delete: %s", inci_id)
+
+        metrics.count(
+            "changes", len(removed_ids), forest=forest["nf_identifier"], kind="removed"
+        )
+
+        return True
+
+    return False
+
+
+# ------------------------------------------------------------------------------
 
-        if start is False:
-            letter_start = 0
-            number_start = 0
+
+def outbox_backoff(attempts):
+    """
+    Seconds to wait before retrying a message that has failed `attempts` times:
+    5s, 10s, 20s... capped at 15 minutes
+    """
+    return min(5 * 2 ** (attempts - 1), 900)
+
+
+def outbox_recipients(message):
+    """
+    Returns the contact dicts an outbox SMS goes to
+    """
+    if message["recipient"]:  # Retry for a single subscriber
+        return [{"number": message["recipient"]}]
+
+    if len(forests) > 1:  # Subscribers only hear about their own forest
+        return contacts.by_alert_level("all", message["forest"])
+
+    return contacts.by_alert_level("all")
+
+
+def deliver_message(message):
+    """
+    Sends one outbox message. Runs on a worker thread, so it must not touch the
+    DB. Returns (state, result, error), where state is sent, skipped or retry
+    """
+    try:
+        if message["channel"] == "telegram":
+            results = send_telegram(
+                message["body"],
+                message["priority"],
+                [message["recipient"]] if message["recipient"] else None,
+            )
         else:
-            split_id = re.findall(r"[A-Za-z]+|\d+", start["id"])
-            letter_start = int(ord(split_id[0])) - 97  # A-Z starts at 97
-            number_start = int(split_id[1])
+            results = send_sms(message["body"], message["recipients"])
+    except Exception as error:  # pylint: disable=broad-except
+        return "retry", None, str(error)
 
-        while new_id_found is False:
-            this_combo = chr(ord("a") + letter_start) + str(number_start)
-            this_db_check = db_urls.search(tinydb.Query().id == this_combo)
+    if results is False:
+        return "skipped", None, None
 
-            if len(this_db_check) == 0:
-                return this_combo
+    if results and all(result["error"] is not None for result in results):
+        return "retry", None, "; ".join(result["error"] for result in results)
 
-            if number_start == 999:  # EG: a99 = roll over to b0
-                letter_start += 1
-                number_start = 0
-            else:
-                number_start += 1
+    return "sent", results, None  # Failed recipients are retried one by one
 
-        return False
 
-    # --------------------------------------------------------------------------
+def record_delivery(message, outcome):
+    """
+    Stores the outcome of deliver_message(): schedules a retry with exponential
+    backoff, or marks the message done and follows up on its result
+    """
+    state, result, error = outcome
 
-    db_results = db_urls.search(tinydb.Query().url == url_str)
-    db_result_last = db_urls.all()
+    if state == "retry" and message["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+        state = "failed"
 
-    if db_results:  # This URL already exists in DB
-        short_url_result = db_results[0]["id"]
-    else:
-        if len(db_result_last) > 0:  # DB has content, use last item as springboard
-            short_url_result = find_new_id(db_result_last[-1])
+    metrics.count("messages", channel=message["channel"], result=state)
+    metrics.count("db_writes", table="outbox")
+
+    for recipient_result in result or []:
+        metrics.count(
+            "recipients",
+            channel=message["channel"],
+            result="ok" if recipient_result["error"] is None else "error",
+        )
+
+    if state in ("retry", "failed"):
+        if state == "failed":
+            logger.error(
+                "Giving up on %s message %s: %s",
+                message["channel"],
+                message["seq"],
+                error,
+            )
+            store.finish_outbox_message(message["seq"], "failed", error=error)
         else:
-            short_url_result = find_new_id(False)
+            logger.debug(
+                "Retrying %s message %s: %s", message["channel"], message["seq"], error
+            )
+            store.finish_outbox_message(
+                message["seq"],
+                "pending",
+                error=error,
+                retry_at=time.time() + outbox_backoff(message["attempts"]),
+            )
+        return
+
+    store.finish_outbox_message(message["seq"], state, result=result)
+
+    if state != "sent":
+        return
+
+    for recipient_result in result:
+        if recipient_result["error"] is not None:
+            store.enqueue({
+                "channel": message["channel"],
+                "priority": message["priority"],
+                "forest": message["forest"],
+                "inci_id": message["inci_id"],
+                "recipient": recipient_result.get("chat_id")
+                or recipient_result.get("number"),
+                "body": message["body"],
+                "next_attempt": time.time() + outbox_backoff(1),
+            })
+        elif (  # Change notifications link to the main chat's first alert
+            message["channel"] == "telegram"
+            and config["telegram_chat_ids"]
+            and recipient_result.get("chat_id") == config["telegram_chat_ids"][0]
+            and message["inci_id"]
+            and message["priority"] == "high"
+        ):
+            store.set_original_message_id(
+                message["forest"], message["inci_id"], recipient_result["message_id"]
+            )
 
-        db_urls.insert({"url": url_str, "id": short_url_result})
 
-    return secrets["URL_SHORT"] + "/" + short_url_result
+async def deliver_outbox(priorities=("high", "low")):
+    """
+    Sends every due outbox message in the given lanes, most urgent first. The
+    sends run on worker threads; only the bookkeeping touches the DB
+    """
+    loop = asyncio.get_running_loop()
+    handled = 0
+
+    while True:
+        message = store.claim_outbox_message(priorities)
+
+        if message is None:
+            return handled
+
+        if message["channel"] == "sms":
+            message["recipients"] = outbox_recipients(message)
+
+        with metrics.timer("send", channel=message["channel"]):
+            sending = loop.run_in_executor(None, deliver_message, message)
+
+            # A long send (EG: an SMS broadcast at TWILIO_MPS) keeps renewing its
+            # lease, so no other lane or run claims the message and sends it again
+            while not sending.done():
+                await asyncio.wait(
+                    {sending},
+                    timeout=max(0.1, (message["leased_until"] - time.time()) / 2),
+                )
+                if not sending.done():
+                    message["leased_until"] = store.renew_outbox_lease(message["seq"])
+
+            outcome = sending.result()
+        record_delivery(message, outcome)
+        handled += 1
+
+
+async def run_delivery_worker():
+    """
+    Daemon: drains the outbox whenever a poll queues messages or a retry falls
+    due. New-fire alerts get a lane of their own, so they never wait behind a
+    long low-priority broadcast
+    """
+
+    async def lane(priorities):
+        wakeup = asyncio.Event()
+        outbox_wakeups.append(wakeup)
+
+        while True:
+            try:
+                await deliver_outbox(priorities)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception("Outbox delivery failed: %s", error)
+
+            due = store.next_outbox_due(priorities)
+            try:
+                await asyncio.wait_for(
+                    wakeup.wait(), None if due is None else max(0.5, due - time.time())
+                )
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+    await asyncio.gather(lane(("high",)), lane(("high", "low")))
 
 
 # ------------------------------------------------------------------------------
 
 
-def perform_cleanup(inci_list):
+def process_forest(page, now=None):
     """
-    Removes entries from the DB no longer present in WildWeb
+    Runs the current forest's freshly-fetched payload through the pipeline:
+    fingerprint, diff against the DB, notify and clean up. Incident changes
+    are kept in memory and committed to the DB in one transaction, stamped
+    unix time `now` (default: now)
     """
-    if inci_list:
-        keep_inci_ids = []
+    nf_identifier = forest["nf_identifier"]
+    forest["incidents"] = store.incident_state(nf_identifier)
 
-        inci_db = tinydb.Query()
+    with metrics.timer("parse", forest=nf_identifier):
+        inci_list, feed_ids = process_wildcad(
+            page,
+            {**forest["ignored_fingerprints"], **forest["incidents"].fingerprints()},
+        )
 
-        for inci in inci_list:
-            keep_inci_ids.append(inci["id"])
+    logger.debug(
+        "%s: %d of %d incidents new or changed",
+        nf_identifier,
+        len(inci_list),
+        len(feed_ids),
+    )
+    metrics.count("incidents_parsed", len(feed_ids), forest=nf_identifier)
+    metrics.count("incidents_decoded", len(inci_list), forest=nf_identifier)
 
-        for inci in db.all():
-            if inci["id"] not in keep_inci_ids:
-                logger.debug("Delete: %s", inci["id"])
-                db.remove(inci_db.id == inci["id"])
+    # Polls in a row with nothing new or changed, see poll_delay()
+    forest["idle_polls"] = 0 if inci_list else forest["idle_polls"] + 1
 
-        return True
+    # Forget rows that have left the feed
+    forest["ignored_fingerprints"] = {
+        inci_id: forest["ignored_fingerprints"][inci_id]
+        for inci_id in feed_ids
+        if inci_id in forest["ignored_fingerprints"]
+    }
 
-    return False
+    with metrics.timer("alerts", forest=nf_identifier):
+        process_alerts(inci_list)
+        process_major_alerts()
+        perform_cleanup(feed_ids)
+
+    commit_incidents(now)
+
+
+def commit_incidents(now=None):
+    """
+    Commits the current forest's IncidentState, recording the writes
+    """
+    incidents = forest["incidents"]
+    writes = len(incidents.changed_ids) + len(incidents.removed_ids)
+    queued = len(incidents.outbox)
+
+    with metrics.timer("db_commit", forest=forest["nf_identifier"]):
+        if incidents.commit(now):
+            metrics.count("db_writes", writes, table="incidents")
+            metrics.count("db_writes", queued, table="outbox")
 
 
 # ------------------------------------------------------------------------------
 
-logger.debug("Running from %s", exec_path)
 
-process_wildcad_inci_list = process_wildcad()
-process_alerts(process_wildcad_inci_list)
-process_major_alerts()
-process_daily_recap()
+async def poll(session, these_forests=None):
+    """
+    Fetches the given forests (default: every configured forest) concurrently,
+    then processes each in turn. Returns False if any could not be fetched
+    """
+    these_forests = forests if these_forests is None else these_forests
+    started = time.perf_counter()
+    pages = await asyncio.gather(
+        *[fetch_wildcad(session, this_forest) for this_forest in these_forests],
+        return_exceptions=True,
+    )
+    all_ok = True
+
+    for this_forest, page in zip(these_forests, pages):
+        use_forest(this_forest)
+
+        if page is None or isinstance(page, Exception):
+            this_forest["idle_polls"] += 1
+
+        if isinstance(page, Exception):
+            all_ok = False
+            if not isinstance(page, WildcadError):
+                logger.error("%s fetch failed: %s", this_forest["nf_identifier"], page)
+        elif page is not None:  # None: nothing new upstream, skip parse/diff/DB/notify
+            logger.debug("Processing %s", this_forest["nf_identifier"])
+            process_forest(page)
+            save_fetch_state(this_forest)
+
+        process_recaps()  # Built from the rollups, so it needs no fresh payload
+
+    store.prune_outbox(time.time() - 7 * 86400)
+
+    if raw_archive is not None:
+        try:
+            raw_archive.prune()
+        except OSError as error:
+            logger.error("Could not prune the raw CAD archive: %s", error)
+
+    for wakeup in outbox_wakeups:  # Daemon: hand new messages to the worker
+        wakeup.set()
+
+    metrics.observe("poll", time.perf_counter() - started)
+    metrics.gauge("last_poll_timestamp_seconds", time.time())
+    metrics.gauge("last_poll_ok", int(all_ok))
+
+    return all_ok
+
+
+def flush_metrics():
+    """
+    Adds everything measured since the last flush to the DB, for server.py's
+    /metrics, and logs it as one structured summary line
+    """
+    rows = metrics.take()
+
+    if not rows:
+        return
+
+    try:
+        store.add_metrics(rows)
+    except sqlite3.Error as error:  # Never let metrics break a poll
+        logger.error("Could not store metrics: %s", error)
+
+    summary_logger.info("Run summary", extra={"metrics": metrics_summary(rows)})
+
+
+# ------------------------------------------------------------------------------
+
+
+def http_session():
+    """
+    Returns the aiohttp session used to fetch WildCAD feeds
+    """
+    import aiohttp  # pylint: disable=import-outside-toplevel
+
+    return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+
+async def run_once():
+    """
+    One full poll of every forest
+    """
+    async with http_session() as session:
+        all_ok = await poll(session)
+
+    await deliver_outbox()
+    flush_metrics()
+
+    return all_ok
+
+
+# ------------------------------------------------------------------------------
+
+
+def poll_delay(this_forest):
+    """
+    Seconds until the daemon fetches a forest again. POLL_FLOOR while one of
+    its fires was new, changed or growing in the last POLL_ACTIVE_WINDOW
+    seconds. Otherwise POLL_INTERVAL, growing 1.5x per idle poll up to
+    POLL_CEILING. Jittered by POLL_JITTER so forests don't fetch in lockstep
+    """
+    if time.time() - this_forest["last_activity"] < config["poll_active_window"]:
+        delay = config["poll_floor"]
+    else:
+        delay = min(
+            config["poll_ceiling"],
+            config["poll_interval"] * 1.5 ** min(this_forest["idle_polls"], 20),
+        )
+
+    delay *= 1 + random.uniform(-config["poll_jitter"], config["poll_jitter"])
+    delay = min(config["poll_ceiling"], max(config["poll_floor"], delay))
+    metrics.gauge("poll_interval_seconds", delay, forest=this_forest["nf_identifier"])
+
+    return delay
+
+
+def poll_budget(this_forest):
+    """
+    Returns the TokenBucket shared by every forest fetched from the same host:
+    POLL_MAX_PER_HOUR fetches an hour for each of those forests, with bursts of
+    up to a quarter of that. Quiet forests leave their share to busy ones
+    """
+    source = urlparse(this_forest["wildcad_url"]).netloc
+
+    if source not in poll_budgets:
+        per_hour = config["poll_max_per_hour"]
+        if per_hour is None:
+            per_hour = 3600 / config["poll_floor"]
+
+        per_hour *= sum(
+            1
+            for other_forest in forests
+            if urlparse(other_forest["wildcad_url"]).netloc == source
+        )
+        poll_budgets[source] = TokenBucket(per_hour / 3600, max(1, int(per_hour // 4)))
+
+    return poll_budgets[source]
+
+
+async def run_daemon():
+    """
+    Keeps the process (and its HTTP sessions and DB connection) alive instead
+    of relying on cron, fetching each forest when it is due, see poll_delay()
+    """
+    logger.debug(
+        "Polling every %s-%s seconds", config["poll_floor"], config["poll_ceiling"]
+    )
+    loop = asyncio.get_running_loop()
+
+    delivery_worker = asyncio.ensure_future(run_delivery_worker())
+
+    try:
+        async with http_session() as session:
+            while True:
+                due = []
+
+                for this_forest in forests:
+                    if this_forest["next_poll"] > loop.time():
+                        continue
+
+                    # Over the host's hourly budget: wait for it, politely
+                    wait = poll_budget(this_forest).delay()
+                    if wait:
+                        this_forest["next_poll"] = loop.time() + wait
+                        metrics.count(
+                            "polls_deferred", forest=this_forest["nf_identifier"]
+                        )
+                    else:
+                        poll_budget(this_forest).take()
+                        due.append(this_forest)
+
+                if due:
+                    try:
+                        await poll(session, due)
+                    except Exception as error:  # pylint: disable=broad-except
+                        logger.exception("Poll failed: %s", error)
+
+                    flush_metrics()  # Includes deliveries since the last poll
+
+                    for this_forest in due:
+                        this_forest["next_poll"] = loop.time() + poll_delay(this_forest)
+
+                next_poll = min(this_forest["next_poll"] for this_forest in forests)
+                await asyncio.sleep(max(0, next_poll - loop.time()))
+    finally:
+        delivery_worker.cancel()
+
+
+# ------------------------------------------------------------------------------
+
+
+def main():
+    """
+    Entry point: a single poll (cron) or a long-running daemon
+    """
+    setup(sys.argv)
+    logger.debug("Running from %s", exec_path)
+
+    if DAEMON:
+        try:
+            asyncio.run(run_daemon())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if not asyncio.run(run_once()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./incident.py
+
+The Incident record passed between the WildCAD parsers, the diff/notification
+code in firebot.py and the store, and the diff engine that compares two of them
+"""
+
+import datetime
+
+# Stable field order: serialization, comparison and change lists follow it
+FEED_FIELDS = (
+    "time_created",
+    "id",
+    "name",
+    "type",
+    "location",  # WildWeb only
+    "comment",
+    "resources",
+    "acres",
+    "x",
+    "y",
+)
+# Set by FireBot, not the feed. fingerprint is a hash of the raw feed record
+STORED_FIELDS = ("original_message_id", "flag_major", "fingerprint")
+FIELDS = FEED_FIELDS + STORED_FIELDS
+
+# ------------------------------------------------------------------------------
+
+
+class Incident:
+    """
+    One incident. A slotted record rather than a dict: smaller, with faster
+    attribute access, when a daemon holds thousands of them. Fields the feed
+    did not report are None
+    """
+
+    __slots__ = FIELDS + ("extra",)
+
+    def __init__(self, **fields):
+        for name in FIELDS:
+            setattr(self, name, fields.pop(name, None))
+
+        self.extra = fields  # Unknown keys from older stored data, kept as-is
+
+    @classmethod
+    def from_dict(cls, inci_dict):
+        """
+        Builds an Incident from its stored dict form
+        """
+        return cls(**inci_dict)
+
+    def to_dict(self):
+        """
+        Returns the stored dict form, leaving out unset fields
+        """
+        inci_dict = {
+            name: getattr(self, name)
+            for name in FIELDS
+            if getattr(self, name) is not None
+        }
+        inci_dict.update(self.extra)
+        return inci_dict
+
+    def values(self):
+        """
+        Returns every field value, in FIELDS order
+        """
+        return tuple(getattr(self, name) for name in FIELDS)
+
+    @property
+    def has_geo(self):
+        """
+        True when the feed gave coordinates
+        """
+        return self.x is not None and self.y is not None
+
+    @property
+    def created_date(self):
+        """
+        The date of time_created as YYYY-MM-DD, from "08/21/2022 14:02"
+        (WildWeb) or "2025-01-18T17:09:25.081" (WildWeb-E). None if neither
+        """
+        value = (self.time_created or "").strip()
+
+        if len(value) >= 10 and value[2] == "/" and value[5] == "/":
+            value = value[6:10] + "-" + value[0:2] + "-" + value[3:5]
+
+        try:
+            return datetime.date.fromisoformat(value[:10]).isoformat()
+        except ValueError:
+            return None
+
+    def merged_over(self, stored):
+        """
+        Returns a copy of this (fresh) incident with any field it lacks taken
+        from the stored one, EG: original_message_id
+        """
+        merged = Incident(**{**stored.extra, **self.extra})
+
+        for name in FIELDS:
+            value = getattr(self, name)
+            setattr(merged, name, getattr(stored, name) if value is None else value)
+
+        return merged
+
+    def __eq__(self, other):
+        if not isinstance(other, Incident):
+            return NotImplemented
+        return self.values() == other.values() and self.extra == other.extra
+
+    __hash__ = None  # Mutable
+
+    def __repr__(self):
+        return "Incident(" + repr(self.to_dict()) + ")"
+
+
+# ------------------------------------------------------------------------------
+
+
+class FieldChange:
+    """
+    One field whose value differs between the stored and fresh incident
+    """
+
+    __slots__ = ("name", "old", "new")
+
+    def __init__(self, name, old, new):
+        self.name = name
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return "FieldChange(%r, %r, %r)" % (self.name, self.old, self.new)
+
+
+class ResourceChange(FieldChange):
+    """
+    A change to the resources roster, broken down into sorted added, removed
+    and unchanged resource lists
+    """
+
+    __slots__ = ("added", "removed", "unchanged")
+
+    def __init__(self, old, new, old_set, new_set):
+        super().__init__("resources", old, new)
+        self.added = sorted(new_set - old_set)
+        self.removed = sorted(old_set - new_set)
+        self.unchanged = sorted(new_set & old_set)
+
+
+IGNORED_CHANGES = frozenset(
+    (
+        "acres",  # Newly-tracked field. Don't notify, just store
+        "time_created",  # No sense in notifying on this one
+    )
+)
+
+# ------------------------------------------------------------------------------
+
+
+def resource_set(resources_str):
+    """
+    Splits a space-separated resources string into a set of resource IDs
+    """
+    return set((resources_str or "").split())
+
+
+def parse_acres(acres_str):
+    """
+    Returns a feed's acres value as a float, 0 if blank or unparseable
+    """
+    try:
+        return float(acres_str or 0)
+    except ValueError:
+        return 0.0
+
+
+def diff_incidents(fresh, stored, ignored=IGNORED_CHANGES):
+    """
+    Compares a fresh Incident against its stored version. Returns a list of
+    FieldChange/ResourceChange records in field order, empty if nothing we
+    notify on changed (pass ignored=() for every change). Fields either side
+    lacks are skipped
+    """
+    changes = []
+
+    for name in FEED_FIELDS:
+        new_value = getattr(fresh, name)
+        old_value = getattr(stored, name)
+
+        if (
+            new_value is None
+            or old_value is None
+            or new_value == old_value
+            or name in ignored
+        ):
+            continue
+
+        if name == "resources":
+            old_set = resource_set(old_value)
+            new_set = resource_set(new_value)
+
+            if old_set != new_set:  # Reordering/whitespace isn't a change
+                changes.append(ResourceChange(old_value, new_value, old_set, new_set))
+        else:
+            changes.append(FieldChange(name, old_value, new_value))
+
+    return changes
@@ -0,0 +1,140 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./metrics.py
+
+Per-stage timings and counters. firebot.py records them in memory and flushes
+them to the shared DB after each run/poll, which is where server.py reads them
+from to serve /metrics in the Prometheus text format
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "firebot_"
+
+# Metric kinds. Counters and timer sums/counts accumulate in the DB, gauges
+# are overwritten
+COUNTER = "counter"
+GAUGE = "gauge"
+
+# ------------------------------------------------------------------------------
+
+
+def label_str(labels):
+    """
+    Returns labels in Prometheus form, EG: {channel="sms",result="sent"}
+    """
+    if not labels:
+        return ""
+
+    return (
+        "{"
+        + ",".join(
+            key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+            for key, value in sorted(labels.items())
+        )
+        + "}"
+    )
+
+
+class Metrics:
+    """
+    Counters, gauges and stage timers collected since the last flush. Safe to
+    use from the SMS/Telegram worker threads
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (name, label string) -> [kind, value]
+
+    def count(self, name, value=1, **labels):
+        """
+        Adds to a counter, EG: count("messages", channel="sms", result="sent")
+        """
+        key = (name + "_total", label_str(labels))
+
+        with self.lock:
+            self.values.setdefault(key, [COUNTER, 0])[1] += value
+
+    def gauge(self, name, value, **labels):
+        """
+        Sets a gauge, EG: gauge("last_poll_timestamp_seconds", time.time())
+        """
+        with self.lock:
+            self.values[(name, label_str(labels))] = [GAUGE, value]
+
+    def observe(self, stage, seconds, **labels):
+        """
+        Records one run of a stage: its duration is added to
+        stage_seconds_sum and its run count to stage_seconds_count
+        """
+        labels = label_str({"stage": stage, **labels})
+
+        with self.lock:
+            self.values.setdefault(("stage_seconds_sum", labels), [COUNTER, 0])[1] += seconds
+            self.values.setdefault(("stage_seconds_count", labels), [COUNTER, 0])[1] += 1
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """
+        Times the enclosed block as one run of `stage`
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, **labels)
+
+    def take(self):
+        """
+        Returns and clears everything collected since the last call, as
+        [(name, labels, kind, value)]
+        """
+        with self.lock:
+            values = self.values
+            self.values = {}
+
+        return [
+            (name, labels, kind, value) for (name, labels), (kind, value) in values.items()
+        ]
+
+
+# ------------------------------------------------------------------------------
+
+
+def summary(rows):
+    """
+    Returns the rows taken from Metrics as a dict for a structured log line,
+    EG: {"messages_total{channel=\"sms\",result=\"sent\"}": 12}
+    """
+    return {
+        name + labels: round(value, 6) if isinstance(value, float) else value
+        for name, labels, _, value in sorted(rows)
+    }
+
+
+def render_prometheus(rows):
+    """
+    Renders stored (name, labels, kind, value) rows in the Prometheus text
+    exposition format
+    """
+    lines = []
+    typed = set()
+
+    for name, labels, kind, value in sorted(rows):
+        family = name[: -len("_sum")] if name.endswith("_sum") else name
+        family = family[: -len("_count")] if family.endswith("_count") else family
+
+        if family not in typed:
+            typed.add(family)
+            if family == "stage_seconds":
+                lines.append("# TYPE " + PREFIX + family + " summary")
+            else:
+                lines.append("# TYPE " + PREFIX + family + " " + kind)
+
+        lines.append(PREFIX + name + labels + " " + repr(float(value)))
+
+    return "\n".join(lines) + "\n"
@@ -7,13 +7,31 @@ https://github.com/acceptableEngineering/nf-firebot
 This is run by Uvicorn to create a server which is contacted by Twilio each time
 someone texts 'Subscribe' or 'Unsubscribe'
 """
+import asyncio
 import json
 import os
-import tinydb
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import dotenv_values
+from store import Store, ShortUrls
+from metrics import render_prometheus
+
+MAX_BODY_BYTES = 16 * 1024  # Twilio's webhook payloads are well under 1 KiB
 
 exec_path = os.path.dirname(os.path.realpath(__file__))
-db = tinydb.TinyDB(exec_path + '/db_contacts.json')
-db_urls = tinydb.TinyDB(exec_path + '/db_urls.json')
+secrets = dotenv_values(exec_path + '/.env')
+
+# Subscribers who don't name a forest get NF_IDENTIFIER (or the first of FORESTS)
+DEFAULT_FOREST = (
+    secrets.get('NF_IDENTIFIER')
+    or (secrets.get('FORESTS') or 'ANF').split(',')[0].split(':')[0].strip()
+)
+
+store = Store()
+short_urls = ShortUrls(store, preload=True)  # Redirects are served from memory
+
+# SQLite work happens on one dedicated thread: the store's connection is shared,
+# and serialising writes there is what SQLite does anyway
+storage_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
 
 # ------------------------------------------------------------------------------
 
@@ -22,16 +40,13 @@ def add_to_db(body):
     Adds a subscriber to the database if not already found in it
     """
     body_phone = str(body['number'])
+    body_forest = str(body.get('forest') or DEFAULT_FOREST).strip().upper()
 
-    db_result = db.search(tinydb.Query().number == body_phone)
-
-    if len(db_result) == 0:
-        db.insert({
-            'number': body_phone,
-            'forest': 'ANF', # Possibly more options in the future, so fill
-            'alert_level': 'all' # Multiple levels of alerts soon, so fill
-        })
-
+    if store.add_contact({
+        'number': body_phone,
+        'forest': body_forest,
+        'alert_level': 'all' # Multiple levels of alerts soon, so fill
+    }):
         return True
 
     return {
@@ -47,13 +62,7 @@ def remove_from_db(body):
     """
     body_phone = str(body['number'])
 
-    db_result = db.search(tinydb.Query().number == body_phone)
-
-    if len(db_result) > 0:
-        db.remove(
-            tinydb.Query().number == body_phone
-        )
-
+    if store.remove_contact(body_phone):
         return True
 
     return {
@@ -70,91 +79,210 @@ def process_response(command_response):
     if command_response is True:
         return {
             "code": 200,
-            "body": "OK"
+            "body": "OK",
+            "content_type": 'text/plain'
         }
 
     return {
         "code": command_response['code'],
-        "body": str(command_response['body'])
+        "body": str(command_response['body']),
+        "content_type": command_response.get('content_type', 'text/plain')
     }
 
 # ------------------------------------------------------------------------------
 
+class BodyTooLarge(Exception):
+    """
+    Raised when a request body exceeds MAX_BODY_BYTES
+    """
+
+# ------------------------------------------------------------------------------
+
 async def read_body(receive):
     """
-    Read and return the entire body from an incoming ASGI message
+    Read and return the entire body from an incoming ASGI message, refusing to
+    buffer more than MAX_BODY_BYTES
     """
-    body = b''
+    chunks = []
+    size = 0
     more_body = True
 
     while more_body:
         message = await receive()
-        body += message.get('body', b'')
+
+        if message['type'] == 'http.disconnect':
+            break
+
+        chunk = message.get('body', b'')
+        size += len(chunk)
+
+        if size > MAX_BODY_BYTES:
+            raise BodyTooLarge()
+
+        chunks.append(chunk)
         more_body = message.get('more_body', False)
 
-    return body
+    return b''.join(chunks)
+
+# ------------------------------------------------------------------------------
+
+async def run_storage(func, *args):
+    """
+    Runs a blocking store call on the storage thread, keeping the event loop free
+    """
+    return await asyncio.get_running_loop().run_in_executor(storage_pool, func, *args)
+
+# ------------------------------------------------------------------------------
+
+async def send_response(send, status, body, headers):
+    """
+    Sends a complete HTTP response
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers
+    })
+
+    await send({
+        'type': 'http.response.body',
+        'body': body.encode('utf-8')
+    })
+
+# ------------------------------------------------------------------------------
+
+async def handle_add(body):
+    """
+    Route: /add
+    """
+    return await run_storage(add_to_db, body)
+
+
+async def handle_remove(body):
+    """
+    Route: /remove
+    """
+    return await run_storage(remove_from_db, body)
+
+
+async def handle_ping():
+    """
+    Route: /ping
+    """
+    return True
+
+
+async def handle_metrics():
+    """
+    Route: /metrics
+    Serves the timings and counters firebot.py stores after each run/poll
+    """
+    rows = await run_storage(store.all_metrics)
+
+    return {
+        "code": 200,
+        "body": render_prometheus(rows),
+        "content_type": 'text/plain; version=0.0.4; charset=utf-8'
+    }
+
+
+# Path -> (handler, whether it is passed the JSON request body)
+ROUTES = {
+    '/add': (handle_add, True),
+    '/remove': (handle_remove, True),
+    '/ping': (handle_ping, False),
+    '/metrics': (handle_metrics, False),
+}
+
+# ------------------------------------------------------------------------------
+
+async def redirect(send, path):
+    """
+    Sends a short-link redirect, or returns an error response if it's unknown
+    """
+    short_id = path.strip('/').split('/')[0]
+
+    if short_id == '':
+        return {
+            "code": 400,
+            "body": 'Invalid URL'
+        }
+
+    # Hits are served from memory; only a miss needs the storage thread
+    redirect_url = short_urls.urls.get(short_id)
+
+    if redirect_url is None:
+        redirect_url = await run_storage(short_urls.get_url, short_id)
+
+    if redirect_url is None:
+        return {
+            "code": 400,
+            "body": 'Path not found'
+        }
+
+    await send_response(
+        send,
+        302,
+        '<head><meta http-equiv="Refresh" content="0; URL=' + redirect_url + '"></head>',
+        [
+            [b'Location', redirect_url.encode('utf-8')],
+            # Short links never change, so let browsers/proxies keep them
+            [b'cache-control', b'public, max-age=86400, immutable'],
+        ]
+    )
 
+    return False
+
+# ------------------------------------------------------------------------------
 
 async def app(scope, receive, send):
     """
-    Echo the method and path back in an HTTP response
+    Routes an incoming request to a handler, falling back to short-link redirects
     """
     assert scope['type'] == 'http'
 
-    body = await read_body(receive)
+    path = scope['path'].strip()
+    route = ROUTES.get(path.rstrip('/') or path)
 
-    if body:
-        body = json.loads(body)
+    try:
+        body = await read_body(receive)
 
-    if scope['path'].strip() == '':
+        if route is None:
+            command_response = await redirect(send, path)
+        else:
+            handler, wants_body = route
+
+            if wants_body:
+                body = json.loads(body) if body else {}
+
+                if not isinstance(body, dict) or 'number' not in body:
+                    raise ValueError('missing number')
+
+                command_response = await handler(body)
+            else:
+                command_response = await handler()
+    except BodyTooLarge:
+        command_response = {
+            "code": 413,
+            "body": 'Request body too large'
+        }
+    except ValueError:
         command_response = {
             "code": 400,
-            "body": 'Invalid URL'
+            "body": 'Invalid request body'
         }
-    if scope['path'].strip() == '/add':
-        command_response = add_to_db(body)
-    elif scope['path'].strip() == '/remove':
-        command_response = remove_from_db(body)
-    elif scope['path'].strip() == '/ping':
-        command_response = True
-    else:
-        request_url_strip = scope['path'].split('/')
-        this_db_check = db_urls.search(tinydb.Query().id == request_url_strip[1].strip())
-        if len(this_db_check) > 0:
-            await send({
-                'type': 'http.response.start',
-                'status': 302,
-                'headers': [
-                    [b'Location', this_db_check[0]['url']],
-                ]
-            })
-            this_body = '<head><meta http-equiv="Refresh" content="0; URL=' + \
-                this_db_check[0]['url'] + '"></head>'
-            await send({
-                'type': 'http.response.body',
-                'body': this_body.encode('utf-8')
-            })
-            command_response = False
-        else:
-            command_response = {
-                "code": 400,
-                "body": 'Path not found'
-            }
 
     if command_response is not False:
         server_response = process_response(command_response)
 
-        await send({
-            'type': 'http.response.start',
-            'status': server_response['code'],
-            'headers': [
-                [b'content-type', b'text/plain'],
+        await send_response(
+            send,
+            server_response['code'],
+            server_response['body'],
+            [
+                [b'content-type', server_response['content_type'].encode('utf-8')],
+                [b'cache-control', b'no-store'],
             ]
-        })
-
-        await send({
-            'type': 'http.response.body',
-            'body': server_response['body'].encode('utf-8')
-        })
+        )
 
 # ------------------------------------------------------------------------------
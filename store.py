@@ -0,0 +1,1210 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./store.py
+
+SQLite storage shared by firebot.py and server.py: live incidents and their
+history, SMS contacts, shortened URLs, the notification outbox and run metrics.
+WAL mode lets both processes read and write concurrently, and every write is a
+transaction, so neither process ever sees a half-written DB.
+
+The incidents table only holds what is in the feed right now. Every incident
+ever stored also has a row in incident_history (first/last seen, when and why
+it closed), with its field revisions in incident_revisions and every resource
+ever assigned to it in incident_resources, indexed for date range queries:
+    python3 store.py history NF_IDENTIFIER INCIDENT_ID
+    python3 store.py count NF_IDENTIFIER YYYY-MM-DD [YYYY-MM-DD] [major]
+
+The legacy TinyDB files (db.json, db_<FOREST>.json, db_contacts.json and
+db_urls.json) are imported automatically the first time the DB is created, or
+on demand with:
+    python3 store.py migrate [NF_IDENTIFIER]
+"""
+
+import datetime
+import glob
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from dotenv import dotenv_values
+from incident import Incident, diff_incidents, parse_acres, resource_set
+
+exec_path = os.path.dirname(os.path.realpath(__file__))
+DB_PATH = exec_path + "/firebot.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS incidents (
+    forest TEXT NOT NULL,
+    id TEXT NOT NULL,
+    time_created TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (forest, id)
+);
+CREATE TABLE IF NOT EXISTS incident_history (
+    forest TEXT NOT NULL,
+    id TEXT NOT NULL,
+    created_date TEXT,
+    type TEXT,
+    flag_major INTEGER NOT NULL DEFAULT 0,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    closed REAL,
+    closed_reason TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (forest, id)
+);
+CREATE INDEX IF NOT EXISTS incident_history_date
+    ON incident_history (forest, created_date);
+CREATE INDEX IF NOT EXISTS incident_history_type
+    ON incident_history (forest, type, created_date);
+CREATE INDEX IF NOT EXISTS incident_history_major
+    ON incident_history (forest, flag_major, created_date);
+CREATE TABLE IF NOT EXISTS incident_revisions (
+    forest TEXT NOT NULL,
+    id TEXT NOT NULL,
+    seen REAL NOT NULL,
+    field TEXT NOT NULL,
+    old TEXT,
+    new TEXT
+);
+CREATE INDEX IF NOT EXISTS incident_revisions_incident
+    ON incident_revisions (forest, id, seen);
+CREATE TABLE IF NOT EXISTS incident_resources (
+    forest TEXT NOT NULL,
+    id TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    PRIMARY KEY (forest, id, resource)
+);
+CREATE INDEX IF NOT EXISTS incident_resources_seen
+    ON incident_resources (forest, first_seen);
+CREATE TABLE IF NOT EXISTS rollups (
+    forest TEXT NOT NULL,
+    period TEXT NOT NULL,
+    start TEXT NOT NULL,
+    fires INTEGER NOT NULL DEFAULT 0,
+    major INTEGER NOT NULL DEFAULT 0,
+    resources INTEGER NOT NULL DEFAULT 0,
+    acres REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (forest, period, start)
+);
+CREATE TABLE IF NOT EXISTS contacts (
+    number TEXT PRIMARY KEY,
+    forest TEXT,
+    alert_level TEXT
+);
+CREATE INDEX IF NOT EXISTS contacts_alert_level ON contacts (alert_level, forest);
+CREATE TABLE IF NOT EXISTS urls (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS fetch_state (
+    forest TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    forest TEXT,
+    inci_id TEXT,
+    recipient TEXT,
+    body TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL,
+    delivered REAL,
+    last_error TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, priority, next_attempt);
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+);
+"""
+
+# Outbox lanes: new-fire alerts always go out ahead of diffs and recaps
+PRIORITIES = {"high": 0, "low": 1}
+
+# A claimed message is handed out again if not finished, or its lease renewed,
+# within this many seconds
+OUTBOX_LEASE = 300
+
+# Rollup counters, each kept per day, per week (from Monday) and per month
+ROLLUP_COUNTERS = ("fires", "major", "resources", "acres")
+PERIODS = ("day", "week", "month")
+
+# ------------------------------------------------------------------------------
+
+
+def period_start(period, day):
+    """
+    Returns the first day of the period a date falls in, EG: for 2025-08-07,
+    week is 2025-08-04 (a Monday) and month is 2025-08-01
+    """
+    if period == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+
+def local_day(timestamp):
+    """
+    Returns the local date of a unix time
+    """
+    return datetime.date.fromtimestamp(timestamp)
+
+
+# ------------------------------------------------------------------------------
+
+
+def read_tinydb_file(path):
+    """
+    Returns {table name: [documents, in insertion order]} from a TinyDB JSON file
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return {}
+
+    with open(path, "r", encoding="utf-8") as file:
+        tables = json.load(file)
+
+    return {
+        table_name: [docs[doc_id] for doc_id in sorted(docs, key=int)]
+        for table_name, docs in tables.items()
+    }
+
+
+# ------------------------------------------------------------------------------
+
+
+def short_id_for_seq(seq):
+    """
+    Maps the URL counter to a short ID: 0 is a0, 999 is a999, 1000 is b0...
+    """
+    return chr(ord("a") + seq // 1000) + str(seq % 1000)
+
+
+def seq_for_short_id(short_id):
+    """
+    Inverse of short_id_for_seq(), EG: b12 is 1012
+    """
+    split_id = re.findall(r"[A-Za-z]+|\d+", short_id)
+    return (ord(split_id[0]) - ord("a")) * 1000 + int(split_id[1])
+
+
+# ------------------------------------------------------------------------------
+
+
+class Store:
+    """
+    One connection to the shared SQLite DB. Each process keeps its own
+    """
+
+    def __init__(self, path=None, legacy_forest=None):
+        path = path or DB_PATH  # Read at call time, so tools can point it elsewhere
+        self.path = path
+        self.conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+        # The legacy JSON files belong next to the default DB only
+        if path == DB_PATH and self.get_meta("migrated") is None:
+            self.migrate_json(legacy_forest)
+
+        if self.get_meta("history_started") is None:
+            self.start_history()
+        if self.get_meta("rollups_started") is None:
+            self.start_rollups()
+
+    # --------------------------------------------------------------------------
+
+    def get_meta(self, key):
+        """
+        Returns a value from the meta key/value table, or None
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key, value):
+        """
+        Sets a value in the meta key/value table
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value))
+        )
+
+    # --------------------------------------------------------------------------
+
+    def all_incidents(self, forest):
+        """
+        Returns every stored incident dict for a forest
+        """
+        rows = self.conn.execute(
+            "SELECT data FROM incidents WHERE forest = ? ORDER BY rowid", (forest,)
+        )
+        return [json.loads(row["data"]) for row in rows]
+
+    def save_incident(self, forest, inci_dict):
+        """
+        Inserts or replaces an incident
+        """
+        self.conn.execute(
+            "INSERT INTO incidents (forest, id, time_created, data)"
+            + " VALUES (?, ?, ?, ?) ON CONFLICT (forest, id) DO UPDATE SET"
+            + " time_created = excluded.time_created, data = excluded.data",
+            (
+                forest,
+                inci_dict["id"],
+                inci_dict.get("time_created"),
+                json.dumps(inci_dict),
+            ),
+        )
+
+    def remove_incident(self, forest, inci_id):
+        """
+        Deletes an incident
+        """
+        self.conn.execute(
+            "DELETE FROM incidents WHERE forest = ? AND id = ?", (forest, inci_id)
+        )
+
+    # --------------------------------------------------------------------------
+
+    def save_history(self, forest, inci, now, rollups=True):
+        """
+        Inserts or updates an incident's lifecycle row and adds any resources
+        not seen on it before. An incident back in the feed is reopened. What
+        changed is added to the rollups
+        """
+        previous = self.conn.execute(
+            "SELECT flag_major, closed_reason, data FROM incident_history"
+            + " WHERE forest = ? AND id = ?",
+            (forest, inci.id),
+        ).fetchone()
+
+        self.conn.execute(
+            "INSERT INTO incident_history (forest, id, created_date, type,"
+            + " flag_major, first_seen, last_seen, data)"
+            + " VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (forest, id) DO UPDATE SET"
+            + " created_date = excluded.created_date, type = excluded.type,"
+            + " flag_major = excluded.flag_major, last_seen = excluded.last_seen,"
+            + " closed = NULL, closed_reason = NULL, data = excluded.data",
+            (
+                forest,
+                inci.id,
+                inci.created_date,
+                inci.type,
+                int(bool(inci.flag_major)),
+                now,
+                now,
+                json.dumps(inci.to_dict()),
+            ),
+        )
+        resources_added = self.conn.executemany(
+            "INSERT OR IGNORE INTO incident_resources (forest, id, resource, first_seen)"
+            + " VALUES (?, ?, ?, ?)",
+            [
+                (forest, inci.id, resource, now)
+                for resource in sorted(resource_set(inci.resources))
+            ],
+        ).rowcount
+
+        if not rollups:
+            return
+
+        today = local_day(now)
+        old_acres = 0.0
+
+        if previous is not None:
+            old_acres = parse_acres(json.loads(previous["data"]).get("acres"))
+
+        # Counted once, on its creation date, unless it stops being a fire
+        if previous is None or previous["closed_reason"] == "not_fire":
+            self.add_rollups(forest, inci.created_date or today, fires=1)
+
+        self.add_rollups(
+            forest,
+            today,
+            major=int(
+                bool(inci.flag_major)
+                and not (previous is not None and previous["flag_major"])
+            ),
+            resources=max(resources_added, 0),
+            acres=parse_acres(inci.acres) - old_acres,
+        )
+
+    def close_history(self, forest, inci_id, reason, now):
+        """
+        Marks an incident as gone: "left_feed", or "not_fire" when its record
+        stopped matching is_fire(), which also takes it out of the fire rollups
+        """
+        row = self.conn.execute(
+            "SELECT created_date, first_seen FROM incident_history"
+            + " WHERE forest = ? AND id = ? AND closed IS NULL",
+            (forest, inci_id),
+        ).fetchone()
+
+        if row is None:
+            return
+
+        self.conn.execute(
+            "UPDATE incident_history SET closed = ?, closed_reason = ?"
+            + " WHERE forest = ? AND id = ?",
+            (now, reason, forest, inci_id),
+        )
+
+        if reason == "not_fire":
+            self.add_rollups(
+                forest, row["created_date"] or local_day(row["first_seen"]), fires=-1
+            )
+
+    def start_history(self):
+        """
+        Seeds the history with the incidents stored before it existed
+        """
+        now = time.time()
+
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            rows = self.conn.execute("SELECT forest, data FROM incidents").fetchall()
+            for row in rows:
+                inci = Incident.from_dict(json.loads(row["data"]))
+                self.save_history(row["forest"], inci, now, rollups=False)
+            self.set_meta("history_started", now)
+
+    # --------------------------------------------------------------------------
+
+    def add_rollups(self, forest, day, **counts):
+        """
+        Adds to a day's counters, and to its week's and month's. `day` is a
+        date or a YYYY-MM-DD string, EG: add_rollups("ANF", day, fires=1)
+        """
+        if not any(counts.values()):
+            return
+
+        if isinstance(day, str):
+            day = datetime.date.fromisoformat(day)
+
+        values = [counts.get(counter, 0) for counter in ROLLUP_COUNTERS]
+
+        self.conn.executemany(
+            "INSERT INTO rollups (forest, period, start, fires, major, resources, acres)"
+            + " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (forest, period, start)"
+            + " DO UPDATE SET fires = fires + excluded.fires,"
+            + " major = major + excluded.major,"
+            + " resources = resources + excluded.resources,"
+            + " acres = acres + excluded.acres",
+            [
+                (forest, period, period_start(period, day).isoformat(), *values)
+                for period in PERIODS
+            ],
+        )
+
+    def get_rollup(self, forest, period, start):
+        """
+        Returns a period's counters as a dict, all 0 if nothing happened in it
+        """
+        row = self.conn.execute(
+            "SELECT fires, major, resources, acres FROM rollups"
+            + " WHERE forest = ? AND period = ? AND start = ?",
+            (forest, period, start),
+        ).fetchone()
+
+        if row is None:
+            return dict.fromkeys(ROLLUP_COUNTERS, 0)
+
+        return dict(row)
+
+    def start_rollups(self):
+        """
+        Builds the rollups from the history stored before they existed.
+        Resources are dated by when they were first seen; everything else by
+        the incident's creation date
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute("DELETE FROM rollups")
+
+            for row in self.conn.execute(
+                "SELECT forest, created_date, first_seen, flag_major, closed_reason,"
+                + " data FROM incident_history"
+            ).fetchall():
+                if row["closed_reason"] == "not_fire":
+                    continue
+                self.add_rollups(
+                    row["forest"],
+                    row["created_date"] or local_day(row["first_seen"]),
+                    fires=1,
+                    major=row["flag_major"],
+                    acres=parse_acres(json.loads(row["data"]).get("acres")),
+                )
+
+            for row in self.conn.execute(
+                "SELECT forest, first_seen FROM incident_resources"
+            ).fetchall():
+                self.add_rollups(row["forest"], local_day(row["first_seen"]), resources=1)
+
+            self.set_meta("rollups_started", time.time())
+
+    def record_recap(self, key, start, message):
+        """
+        Queues a recap (or, with message None, just marks it done) unless the
+        meta key says it has already been sent for this period or a later
+        one. Checked and written in one transaction, so each recap goes out
+        exactly once even with overlapping runs. Returns True if recorded
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            last_start = self.get_meta(key)
+
+            if last_start is not None and last_start >= start:
+                return False
+
+            if message is not None:
+                self.enqueue(message)
+            self.set_meta(key, start)
+
+        return True
+
+    def count_history(self, forest, start_date, end_date=None, major=None):
+        """
+        Returns how many fire incidents were created between two YYYY-MM-DD
+        dates (inclusive, end defaults to start), optionally only major ones.
+        Incidents later found not to be fires are left out
+        """
+        sql = (
+            "SELECT COUNT(*) FROM incident_history WHERE forest = ?"
+            + " AND created_date BETWEEN ? AND ?"
+            + " AND closed_reason IS NOT 'not_fire'"
+        )
+        params = [forest, start_date, end_date or start_date]
+
+        if major is not None:
+            sql += " AND flag_major = ?"
+            params.append(int(major))
+
+        return self.conn.execute(sql, params).fetchone()[0]
+
+    def incident_lifecycle(self, forest, inci_id):
+        """
+        Returns an incident's history row as a dict, with its "revisions"
+        ({seen, field, old, new}, oldest first) and "resources" ({resource,
+        first_seen}). None if it was never stored
+        """
+        row = self.conn.execute(
+            "SELECT * FROM incident_history WHERE forest = ? AND id = ?",
+            (forest, inci_id),
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        lifecycle = dict(row)
+        lifecycle["data"] = json.loads(row["data"])
+        lifecycle["revisions"] = [
+            dict(revision)
+            for revision in self.conn.execute(
+                "SELECT seen, field, old, new FROM incident_revisions"
+                + " WHERE forest = ? AND id = ? ORDER BY seen, rowid",
+                (forest, inci_id),
+            )
+        ]
+        lifecycle["resources"] = [
+            dict(resource)
+            for resource in self.conn.execute(
+                "SELECT resource, first_seen FROM incident_resources"
+                + " WHERE forest = ? AND id = ? ORDER BY first_seen, resource",
+                (forest, inci_id),
+            )
+        ]
+
+        return lifecycle
+
+    def incident_state(self, forest):
+        """
+        Returns a run-scoped IncidentState for a forest
+        """
+        return IncidentState(self, forest)
+
+    # --------------------------------------------------------------------------
+
+    def contacts_by_alert_level(self, alert_level, forest=None):
+        """
+        Returns subscriber dicts for an alert level, optionally for one forest
+        """
+        if forest is None:
+            rows = self.conn.execute(
+                "SELECT number, forest, alert_level FROM contacts WHERE alert_level = ?",
+                (alert_level,),
+            )
+        else:
+            rows = self.conn.execute(
+                "SELECT number, forest, alert_level FROM contacts"
+                + " WHERE alert_level = ? AND forest = ?",
+                (alert_level, forest),
+            )
+        return [dict(row) for row in rows]
+
+    def contacts_seq(self):
+        """
+        Change-sequence number for the contacts table, bumped by every write
+        """
+        return int(self.get_meta("contacts_seq") or 0)
+
+    def bump_contacts_seq(self):
+        """
+        Marks the contacts table as changed. Call inside the writing transaction
+        """
+        self.conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('contacts_seq', '1')"
+            + " ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+
+    def add_contact(self, contact_dict):
+        """
+        Adds a subscriber. Returns False if the number was already subscribed
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO contacts (number, forest, alert_level)"
+                + " VALUES (?, ?, ?)",
+                (contact_dict["number"], contact_dict["forest"], contact_dict["alert_level"]),
+            )
+            if cursor.rowcount > 0:
+                self.bump_contacts_seq()
+
+        return cursor.rowcount > 0
+
+    def remove_contact(self, number):
+        """
+        Removes a subscriber. Returns False if the number was not subscribed
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            cursor = self.conn.execute("DELETE FROM contacts WHERE number = ?", (number,))
+            if cursor.rowcount > 0:
+                self.bump_contacts_seq()
+
+        return cursor.rowcount > 0
+
+    # --------------------------------------------------------------------------
+
+    def url_for_id(self, short_id):
+        """
+        Returns the full URL for a short ID, or None
+        """
+        row = self.conn.execute("SELECT url FROM urls WHERE id = ?", (short_id,)).fetchone()
+        return row["url"] if row else None
+
+    def id_for_url(self, url):
+        """
+        Returns the short ID a URL was given, or None
+        """
+        row = self.conn.execute("SELECT id FROM urls WHERE url = ?", (url,)).fetchone()
+        return row["id"] if row else None
+
+    def urls_since(self, rowid):
+        """
+        Returns (rowid, short ID, URL) for every URL stored after the given rowid
+        """
+        return [
+            (row["rowid"], row["id"], row["url"])
+            for row in self.conn.execute(
+                "SELECT rowid, id, url FROM urls WHERE rowid > ? ORDER BY rowid",
+                (rowid,),
+            )
+        ]
+
+    def data_version(self):
+        """
+        Changes whenever another connection commits to the DB. Cheap to poll
+        """
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def allocate_url_id(self, url):
+        """
+        Returns the URL's short ID, allocating the next one from the persisted
+        counter if it has not been shortened before
+        """
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")  # Serializes the counter
+
+            row = self.conn.execute("SELECT id FROM urls WHERE url = ?", (url,)).fetchone()
+            if row:
+                return row["id"]
+
+            seq = self.get_meta("url_seq")
+
+            if seq is None:  # First allocation since migrating: follow the last ID
+                row = self.conn.execute(
+                    "SELECT id FROM urls ORDER BY rowid DESC LIMIT 1"
+                ).fetchone()
+                seq = seq_for_short_id(row["id"]) + 1 if row else 0
+            else:
+                seq = int(seq)
+
+            # Only IDs created before the counter existed can be taken
+            while self.url_for_id(short_id_for_seq(seq)) is not None:
+                seq += 1
+
+            short_id = short_id_for_seq(seq)
+            self.conn.execute("INSERT INTO urls (id, url) VALUES (?, ?)", (short_id, url))
+            self.set_meta("url_seq", seq + 1)
+
+        return short_id
+
+    # --------------------------------------------------------------------------
+
+    def set_original_message_id(self, forest, inci_id, message_id):
+        """
+        Records the Telegram message ID of an incident's first alert, which
+        later change notifications link back to
+        """
+        self.conn.execute(
+            "UPDATE incidents SET data = json_set(data, '$.original_message_id', ?)"
+            + " WHERE forest = ? AND id = ?",
+            (message_id, forest, inci_id),
+        )
+
+    # --------------------------------------------------------------------------
+
+    def get_fetch_state(self, forest):
+        """
+        Returns the last processed fetch's validators/digest for a forest
+        """
+        row = self.conn.execute(
+            "SELECT data FROM fetch_state WHERE forest = ?", (forest,)
+        ).fetchone()
+        return json.loads(row["data"]) if row else {}
+
+    def set_fetch_state(self, forest, fetch_state):
+        """
+        Stores the last processed fetch's validators/digest for a forest
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO fetch_state (forest, data) VALUES (?, ?)",
+            (forest, json.dumps(fetch_state)),
+        )
+
+    # --------------------------------------------------------------------------
+
+    def enqueue(self, message):
+        """
+        Adds a message dict (channel, priority, body, and optionally forest,
+        inci_id, recipient, next_attempt) to the outbox
+        """
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO outbox (channel, priority, forest, inci_id, recipient, body,"
+            + " next_attempt, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                message["channel"],
+                PRIORITIES[message["priority"]],
+                message.get("forest"),
+                message.get("inci_id"),
+                message.get("recipient"),
+                message["body"],
+                message.get("next_attempt", now),
+                now,
+            ),
+        )
+
+    def claim_outbox_message(self, priorities=("high", "low")):
+        """
+        Takes the most urgent due message in the given lanes, leasing it so no
+        other worker sends it too. Returns a dict, or None when nothing is due
+        """
+        now = time.time()
+        lanes = [PRIORITIES[priority] for priority in priorities]
+
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute(
+                "SELECT * FROM outbox WHERE state IN ('pending', 'sending')"
+                + " AND next_attempt <= ? AND priority IN ("
+                + ",".join("?" * len(lanes))
+                + ") ORDER BY priority, seq LIMIT 1",
+                [now] + lanes,
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            self.conn.execute(
+                "UPDATE outbox SET state = 'sending', attempts = attempts + 1,"
+                + " next_attempt = ? WHERE seq = ?",
+                (now + OUTBOX_LEASE, row["seq"]),
+            )
+
+        message = dict(row)
+        message["attempts"] += 1
+        message["priority"] = "high" if row["priority"] == 0 else "low"
+        message["leased_until"] = now + OUTBOX_LEASE
+
+        return message
+
+    def renew_outbox_lease(self, seq):
+        """
+        Extends the lease on a message that is still being sent. Returns when
+        the new lease runs out
+        """
+        leased_until = time.time() + OUTBOX_LEASE
+        self.conn.execute(
+            "UPDATE outbox SET next_attempt = ? WHERE seq = ? AND state = 'sending'",
+            (leased_until, seq),
+        )
+
+        return leased_until
+
+    def finish_outbox_message(self, seq, state, result=None, error=None, retry_at=None):
+        """
+        Records a delivery attempt: state is sent, skipped, failed, or pending
+        (with retry_at) to try again later
+        """
+        self.conn.execute(
+            "UPDATE outbox SET state = ?, result = ?, last_error = ?,"
+            + " next_attempt = COALESCE(?, next_attempt), delivered = ?"
+            + " WHERE seq = ?",
+            (
+                state,
+                None if result is None else json.dumps(result),
+                error,
+                retry_at,
+                time.time() if state == "sent" else None,
+                seq,
+            ),
+        )
+
+    def next_outbox_due(self, priorities=("high", "low")):
+        """
+        Returns the time the next pending message in the given lanes is due,
+        or None if the outbox is empty
+        """
+        lanes = [PRIORITIES[priority] for priority in priorities]
+        row = self.conn.execute(
+            "SELECT MIN(next_attempt) AS due FROM outbox"
+            + " WHERE state IN ('pending', 'sending') AND priority IN ("
+            + ",".join("?" * len(lanes))
+            + ")",
+            lanes,
+        ).fetchone()
+        return row["due"]
+
+    def prune_outbox(self, older_than):
+        """
+        Deletes finished messages created before the given timestamp
+        """
+        self.conn.execute(
+            "DELETE FROM outbox WHERE state IN ('sent', 'skipped', 'failed')"
+            + " AND created < ?",
+            (older_than,),
+        )
+
+    # --------------------------------------------------------------------------
+
+    def add_metrics(self, rows):
+        """
+        Merges (name, labels, kind, value) rows from metrics.Metrics.take() in
+        one transaction: counters are added to, gauges replaced
+        """
+        now = time.time()
+
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT INTO metrics (name, labels, kind, value, updated)"
+                + " VALUES (?, ?, ?, ?, ?) ON CONFLICT (name, labels) DO UPDATE SET"
+                + " value = CASE WHEN excluded.kind = 'counter'"
+                + " THEN value + excluded.value ELSE excluded.value END,"
+                + " kind = excluded.kind, updated = excluded.updated",
+                [(name, labels, kind, value, now) for name, labels, kind, value in rows],
+            )
+
+    def all_metrics(self):
+        """
+        Returns every stored metric as (name, labels, kind, value)
+        """
+        return [
+            (row["name"], row["labels"], row["kind"], row["value"])
+            for row in self.conn.execute("SELECT name, labels, kind, value FROM metrics")
+        ]
+
+    # --------------------------------------------------------------------------
+
+    def migrate_json(self, legacy_forest=None):
+        """
+        One-shot import of the TinyDB JSON files found next to this script.
+        db.json belongs to legacy_forest (defaults to NF_IDENTIFIER in .env),
+        db_<FOREST>.json files to the forest in their name. Existing rows win
+        """
+        if legacy_forest is None:
+            legacy_forest = dotenv_values(exec_path + "/.env").get("NF_IDENTIFIER")
+
+        incident_files = {}
+        if legacy_forest:
+            incident_files[exec_path + "/db.json"] = legacy_forest
+        for path in glob.glob(exec_path + "/db_*.json"):
+            forest = os.path.basename(path)[3:-5]
+            if forest not in ("contacts", "urls"):
+                incident_files[path] = forest
+
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")  # Only one process migrates
+
+            if self.get_meta("migrated") is not None:
+                return False
+
+            for path, forest in incident_files.items():
+                tables = read_tinydb_file(path)
+
+                for inci_dict in tables.get("_default", []):
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO incidents"
+                        + " (forest, id, time_created, data) VALUES (?, ?, ?, ?)",
+                        (
+                            forest,
+                            inci_dict["id"],
+                            inci_dict.get("time_created"),
+                            json.dumps(inci_dict),
+                        ),
+                    )
+
+                for fetch_state in tables.get("fetch_state", []):
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO fetch_state (forest, data) VALUES (?, ?)",
+                        (forest, json.dumps(fetch_state)),
+                    )
+
+            for contact in read_tinydb_file(exec_path + "/db_contacts.json").get(
+                "_default", []
+            ):
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO contacts (number, forest, alert_level)"
+                    + " VALUES (?, ?, ?)",
+                    (
+                        str(contact["number"]),
+                        contact.get("forest"),
+                        contact.get("alert_level"),
+                    ),
+                )
+
+            for url in read_tinydb_file(exec_path + "/db_urls.json").get("_default", []):
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO urls (id, url) VALUES (?, ?)",
+                    (url["id"], url["url"]),
+                )
+
+            self.bump_contacts_seq()
+            self.set_meta("migrated", 1)
+
+        return True
+
+
+# ------------------------------------------------------------------------------
+
+
+class IncidentState:
+    """
+    Unit of work over one forest's incidents for a single run: loaded with one
+    query as Incident records, changed in memory, and written back, along with
+    their history, in one transaction by commit()
+    """
+
+    def __init__(self, store, forest):
+        self.store = store
+        self.forest = forest
+        self.incidents = {}
+
+        for inci_dict in store.all_incidents(forest):
+            inci = Incident.from_dict(inci_dict)
+            self.incidents[inci.id] = inci
+
+        self.changed_ids = set()
+        self.removed_ids = {}  # ID -> reason, for the history
+        self.revisions = []  # (ID, FieldChange), for the history
+        self.seen = False
+        self.outbox = []
+
+    def get(self, inci_id):
+        """
+        Returns the Incident, or None
+        """
+        return self.incidents.get(inci_id)
+
+    def all(self):
+        """
+        Returns every Incident, oldest first
+        """
+        return list(self.incidents.values())
+
+    def fingerprints(self):
+        """
+        Returns {ID: fingerprint} for the incidents that have one
+        """
+        return {
+            inci_id: inci.fingerprint
+            for inci_id, inci in self.incidents.items()
+            if inci.fingerprint is not None
+        }
+
+    def save(self, inci):
+        """
+        Inserts or replaces an Incident. Every field that differs from the
+        stored version is kept as a revision in the history
+        """
+        stored = self.incidents.get(inci.id)
+
+        if stored is not None and stored is not inci:
+            self.revisions.extend(
+                (inci.id, change) for change in diff_incidents(inci, stored, ignored=())
+            )
+
+        self.incidents[inci.id] = inci
+        self.changed_ids.add(inci.id)
+        self.removed_ids.pop(inci.id, None)
+
+    def remove(self, inci_id, reason="left_feed"):
+        """
+        Deletes an incident from the live set. Its history is kept, closed
+        with the given reason
+        """
+        self.incidents.pop(inci_id, None)
+        self.removed_ids[inci_id] = reason
+        self.changed_ids.discard(inci_id)
+
+    def see(self):
+        """
+        Notes that the live set was just checked against the full feed, so
+        every incident left in it is still listed there
+        """
+        self.seen = True
+
+    def remove_except(self, keep_ids):
+        """
+        Deletes every incident whose ID is not in keep_ids. Returns the deleted
+        IDs
+        """
+        keep_ids = set(keep_ids)
+        removed_ids = [inci_id for inci_id in self.incidents if inci_id not in keep_ids]
+
+        for inci_id in removed_ids:
+            self.remove(inci_id)
+
+        return removed_ids
+
+    def enqueue(self, channel, body, priority, inci_id=None):
+        """
+        Queues a notification, written to the outbox together with the incident
+        changes that caused it
+        """
+        self.outbox.append(
+            {
+                "channel": channel,
+                "priority": priority,
+                "forest": self.forest,
+                "inci_id": inci_id,
+                "body": body,
+            }
+        )
+
+    def commit(self, now=None):
+        """
+        Writes every change and queued notification made during the run in a
+        single transaction, stamped `now` (default: the current time)
+        """
+        if (
+            not self.changed_ids
+            and not self.removed_ids
+            and not self.outbox
+            and not self.seen
+        ):
+            return False
+
+        conn = self.store.conn
+        now = time.time() if now is None else now
+
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "DELETE FROM incidents WHERE forest = ? AND id = ?",
+                [(self.forest, inci_id) for inci_id in self.removed_ids],
+            )
+            for inci_id, reason in self.removed_ids.items():
+                self.store.close_history(self.forest, inci_id, reason, now)
+            for inci_id in self.changed_ids:
+                inci = self.incidents[inci_id]
+                self.store.save_incident(self.forest, inci.to_dict())
+                self.store.save_history(self.forest, inci, now)
+            conn.executemany(
+                "INSERT INTO incident_revisions (forest, id, seen, field, old, new)"
+                + " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (self.forest, inci_id, now, change.name, change.old, change.new)
+                    for inci_id, change in self.revisions
+                ],
+            )
+            if self.seen:  # Everything still open was in this payload
+                conn.execute(
+                    "UPDATE incident_history SET last_seen = ?"
+                    + " WHERE forest = ? AND closed IS NULL",
+                    (now, self.forest),
+                )
+            for message in self.outbox:
+                self.store.enqueue(message)
+
+        self.changed_ids = set()
+        self.removed_ids = {}
+        self.revisions = []
+        self.seen = False
+        self.outbox = []
+
+        return True
+
+
+# ------------------------------------------------------------------------------
+
+
+class ShortUrls:
+    """
+    In-memory URL <-> short ID index over the urls table, so lookups never hit
+    the DB and allocation is a single counter bump. Short IDs never change once
+    allocated, so the index only ever needs to pick up new rows. Only
+    long-lived processes (preload) load the whole table; a cron run looks up
+    just the URLs it shortens
+    """
+
+    def __init__(self, store, preload=False):
+        self.store = store
+        self.preload = preload
+        self.ids = {}
+        self.urls = {}
+        self.last_rowid = None
+        self.data_version = None
+
+    def refresh(self):
+        """
+        Adds URLs stored (by any process) since the last refresh. Skipped when
+        no other connection has committed anything since
+        """
+        data_version = self.store.data_version()
+
+        if self.last_rowid is not None and data_version == self.data_version:
+            return False
+
+        self.data_version = data_version
+
+        for rowid, short_id, url in self.store.urls_since(self.last_rowid or 0):
+            self.ids[url] = short_id
+            self.urls[short_id] = url
+            self.last_rowid = rowid
+
+        if self.last_rowid is None:
+            self.last_rowid = 0
+
+        return True
+
+    def get_url(self, short_id):
+        """
+        Returns the full URL for a short ID, or None. Only a miss touches the DB
+        """
+        if short_id not in self.urls:
+            self.refresh()
+        return self.urls.get(short_id)
+
+    def get_id(self, url):
+        """
+        Returns the URL's short ID, allocating one if needed
+        """
+        if self.preload and self.last_rowid is None:
+            self.refresh()
+
+        if url not in self.ids:
+            short_id = None if self.preload else self.store.id_for_url(url)
+            short_id = short_id or self.store.allocate_url_id(url)
+            self.ids[url] = short_id
+            self.urls[short_id] = url
+
+        return self.ids[url]
+
+
+class Contacts:
+    """
+    In-memory cache of subscriber lists, keyed by (alert level, forest). Reloaded
+    only when the contacts change-sequence number moves, which happens in the
+    same transaction as every subscribe/unsubscribe from any process
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.seq = None
+        self.cache = {}
+
+    def by_alert_level(self, alert_level, forest=None):
+        """
+        Returns subscriber dicts for an alert level, optionally for one forest
+        """
+        seq = self.store.contacts_seq()
+
+        if seq != self.seq:
+            self.cache = {}
+            self.seq = seq
+
+        key = (alert_level, forest)
+
+        if key not in self.cache:
+            self.cache[key] = self.store.contacts_by_alert_level(alert_level, forest)
+
+        return self.cache[key]
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        cli_forest = sys.argv[2] if len(sys.argv) > 2 else None
+        cli_store = Store(legacy_forest=cli_forest)
+        # Allow re-running, EG: after dropping in a new db_contacts.json
+        cli_store.conn.execute("DELETE FROM meta WHERE key = 'migrated'")
+        cli_store.migrate_json(cli_forest)
+        print("Migrated TinyDB JSON files into " + DB_PATH)
+    elif len(sys.argv) > 3 and sys.argv[1] == "history":
+        cli_lifecycle = Store().incident_lifecycle(sys.argv[2], sys.argv[3])
+        if cli_lifecycle is None:
+            sys.exit("No history for " + sys.argv[3])
+        print(json.dumps(cli_lifecycle, indent=2))
+    elif len(sys.argv) > 3 and sys.argv[1] == "count":
+        cli_dates = [arg for arg in sys.argv[3:] if arg != "major"]
+        print(
+            Store().count_history(
+                sys.argv[2],
+                cli_dates[0],
+                cli_dates[1] if len(cli_dates) > 1 else None,
+                True if "major" in sys.argv[3:] else None,
+            )
+        )
+    else:
+        print(
+            "Usage: python3 store.py migrate [NF_IDENTIFIER]\n"
+            + "       python3 store.py history NF_IDENTIFIER INCIDENT_ID\n"
+            + "       python3 store.py count NF_IDENTIFIER YYYY-MM-DD [YYYY-MM-DD] [major]"
+        )
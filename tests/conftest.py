@@ -0,0 +1,91 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./tests/conftest.py
+
+Fixtures that run firebot.py against a throwaway .env and SQLite DB:
+    python3 -m pytest -q
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+repo_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repo_path)
+
+import store as store_module  # pylint: disable=wrong-import-position
+
+WWE_MOCK_PATH = os.path.join(repo_path, ".development", "wildweb-e_mock_data.json")
+
+# ------------------------------------------------------------------------------
+
+
+def write_env(path, env):
+    """
+    Writes a .env file from a dict
+    """
+    with open(os.path.join(path, ".env"), "w", encoding="utf-8") as env_file:
+        env_file.write(
+            "".join(key + "=" + str(value) + "\n" for key, value in env.items())
+        )
+
+
+@pytest.fixture
+def make_firebot(tmp_path, monkeypatch):
+    """
+    Returns a function that sets firebot.py up against `env` (added to a
+    WildWeb-E ANF .env) in tmp_path, with a fresh DB, and returns the module
+    """
+    import firebot  # pylint: disable=import-outside-toplevel
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(store_module, "DB_PATH", str(tmp_path / "firebot.sqlite3"))
+    handlers = list(firebot.logger.handlers)
+
+    def make(env=None):
+        write_env(
+            tmp_path,
+            {
+                "NF_IDENTIFIER": "ANF",
+                "WILDWEB_E": "True",
+                "NF_WWE_IDENTIFIER": "caancc",
+                **(env or {}),
+            },
+        )
+        firebot.setup(["firebot.py"])
+        firebot.metrics.take()
+
+        return firebot
+
+    yield make
+
+    if firebot.store is not None:
+        firebot.store.conn.close()
+        firebot.store = None
+
+    for handler in firebot.logger.handlers:
+        if handler not in handlers:
+            handler.close()
+            firebot.logger.removeHandler(handler)
+            firebot.summary_logger.removeHandler(handler)
+
+
+@pytest.fixture
+def wwe_items():
+    """
+    Returns the records of the WildWeb-E mock feed, to edit and re-encode with
+    wwe_page()
+    """
+    with open(WWE_MOCK_PATH, "r", encoding="utf-8") as mock_file:
+        return json.load(mock_file)[0]["data"]
+
+
+def wwe_page(items):
+    """
+    Returns a WildWeb-E payload holding `items`
+    """
+    return json.dumps([{"data": items}])
@@ -0,0 +1,299 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./tests/test_outbox.py
+
+Outbox delivery: leases, backoff, giving up, per-recipient retries, and the
+main chat's message ID
+"""
+
+import asyncio
+import time
+import types
+
+import pytest
+
+import store as store_module
+
+TWO_CHATS = {"TELEGRAM_CHAT_ID": "@main,@backup"}
+
+# ------------------------------------------------------------------------------
+
+
+@pytest.fixture
+def telegram_sends(monkeypatch):
+    """
+    Stubs send_telegram(). Returns the list of chat_ids lists it was called
+    with. Set .results to a function of chat_id returning (message_id, error)
+    """
+    import firebot  # pylint: disable=import-outside-toplevel
+
+    calls = types.SimpleNamespace(
+        chat_ids=[], results=lambda chat_id: (len(chat_id), None)
+    )
+
+    def send_telegram(_message_str, _priority_str, chat_ids=None):
+        chat_ids = chat_ids or firebot.config["telegram_chat_ids"]
+        calls.chat_ids.append(chat_ids)
+        results = []
+
+        for chat_id in chat_ids:
+            message_id, error = calls.results(chat_id)
+            results.append(
+                {"chat_id": chat_id, "message_id": message_id, "error": error}
+            )
+
+        return results
+
+    monkeypatch.setattr(firebot, "send_telegram", send_telegram)
+
+    return calls
+
+
+@pytest.fixture
+def sms_sends(monkeypatch):
+    """
+    Stubs send_sms(). Returns the list of number lists it was called with.
+    Numbers in .failing get an error
+    """
+    import firebot  # pylint: disable=import-outside-toplevel
+
+    calls = types.SimpleNamespace(numbers=[], failing=set())
+
+    def send_sms(_message_str, recipients):
+        numbers = [recipient["number"] for recipient in recipients]
+        calls.numbers.append(numbers)
+
+        return [
+            {
+                "number": number,
+                "sid": None if number in calls.failing else "SM" + number,
+                "error": "HTTP 500" if number in calls.failing else None,
+            }
+            for number in numbers
+        ]
+
+    monkeypatch.setattr(firebot, "send_sms", send_sms)
+
+    return calls
+
+
+def enqueue(firebot, channel, priority="low", inci_id=None):
+    """
+    Queues a message for ANF, due now
+    """
+    firebot.store.enqueue(
+        {
+            "channel": channel,
+            "priority": priority,
+            "forest": "ANF",
+            "inci_id": inci_id,
+            "body": "Test " + channel + " message",
+        }
+    )
+
+
+def outbox_rows(firebot):
+    """
+    Returns every outbox message, oldest first
+    """
+    return [
+        dict(row)
+        for row in firebot.store.conn.execute("SELECT * FROM outbox ORDER BY seq")
+    ]
+
+
+def make_due(firebot):
+    """
+    Brings every scheduled retry forward to now
+    """
+    firebot.store.conn.execute(
+        "UPDATE outbox SET next_attempt = 0 WHERE state = 'pending'"
+    )
+
+
+# ------------------------------------------------------------------------------
+
+
+def test_partial_telegram_failure_retries_failed_chat(make_firebot, telegram_sends):
+    """
+    A message that reached the main chat but not the backup one is marked
+    sent, and retried for the backup chat alone
+    """
+    firebot = make_firebot(TWO_CHATS)
+    telegram_sends.results = lambda chat_id: (
+        (None, "HTTP 500") if chat_id == "@backup" else (1, None)
+    )
+    enqueue(firebot, "telegram")
+
+    assert asyncio.run(firebot.deliver_outbox()) == 1
+
+    first, retry = outbox_rows(firebot)
+    assert first["state"] == "sent"
+    assert (retry["state"], retry["recipient"]) == ("pending", "@backup")
+    assert asyncio.run(firebot.deliver_outbox()) == 0  # Backing off
+
+    telegram_sends.results = lambda chat_id: (2, None)
+    make_due(firebot)
+
+    assert asyncio.run(firebot.deliver_outbox()) == 1
+    assert telegram_sends.chat_ids == [["@main", "@backup"], ["@backup"]]
+    assert [row["state"] for row in outbox_rows(firebot)] == ["sent", "sent"]
+
+
+def test_partial_sms_failure_retries_failed_number_only(make_firebot, sms_sends):
+    """
+    A broadcast that reached some subscribers is retried for the others alone
+    """
+    firebot = make_firebot(TWO_CHATS)
+
+    for number in ("+15555550100", "+15555550101"):
+        firebot.store.add_contact(
+            {"number": number, "forest": "ANF", "alert_level": "all"}
+        )
+
+    sms_sends.failing = {"+15555550101"}
+    enqueue(firebot, "sms")
+    asyncio.run(firebot.deliver_outbox())
+
+    first, retry = outbox_rows(firebot)
+    assert first["state"] == "sent"
+    assert (retry["state"], retry["recipient"]) == ("pending", "+15555550101")
+
+    sms_sends.failing = set()
+    make_due(firebot)
+    asyncio.run(firebot.deliver_outbox())
+
+    assert sms_sends.numbers == [["+15555550100", "+15555550101"], ["+15555550101"]]
+    assert [row["state"] for row in outbox_rows(firebot)] == ["sent", "sent"]
+
+
+def test_lease_expires(make_firebot, monkeypatch):
+    """
+    A claimed message is not handed out again until its lease runs out, EG
+    when the worker that claimed it died mid-send
+    """
+    firebot = make_firebot(TWO_CHATS)
+    enqueue(firebot, "telegram")
+
+    claimed = firebot.store.claim_outbox_message()
+    assert claimed["attempts"] == 1
+    assert firebot.store.claim_outbox_message() is None
+
+    later = claimed["next_attempt"] + store_module.OUTBOX_LEASE + 1
+    monkeypatch.setattr(store_module, "time", types.SimpleNamespace(time=lambda: later))
+    reclaimed = firebot.store.claim_outbox_message()
+
+    assert reclaimed["seq"] == claimed["seq"]
+    assert reclaimed["attempts"] == 2
+
+
+def test_long_send_keeps_its_lease(make_firebot, sms_sends, monkeypatch):
+    """
+    A send that outlasts OUTBOX_LEASE, EG a broadcast to hundreds of
+    subscribers at TWILIO_MPS, renews its lease, so neither daemon lane sends
+    the message a second time
+    """
+    firebot = make_firebot(TWO_CHATS)
+    firebot.store.add_contact(
+        {"number": "+15555550100", "forest": "ANF", "alert_level": "all"}
+    )
+    monkeypatch.setattr(store_module, "OUTBOX_LEASE", 0.5)
+    monkeypatch.setattr(firebot, "outbox_wakeups", [])
+    stub_send_sms = firebot.send_sms
+
+    def slow_send_sms(message_str, recipients):
+        time.sleep(1.5)
+        return stub_send_sms(message_str, recipients)
+
+    monkeypatch.setattr(firebot, "send_sms", slow_send_sms)
+    enqueue(firebot, "sms", "high")
+
+    async def run_worker():
+        worker = asyncio.ensure_future(firebot.run_delivery_worker())
+        await asyncio.sleep(2.5)
+        worker.cancel()
+
+    asyncio.run(run_worker())
+
+    assert sms_sends.numbers == [["+15555550100"]]
+    assert [row["state"] for row in outbox_rows(firebot)] == ["sent"]
+
+
+def test_gives_up_after_max_attempts(make_firebot, telegram_sends):
+    """
+    A message that keeps failing is retried with backoff, then marked failed
+    after OUTBOX_MAX_ATTEMPTS
+    """
+    firebot = make_firebot(TWO_CHATS)
+    telegram_sends.results = lambda chat_id: (None, "HTTP 500")
+    enqueue(firebot, "telegram")
+
+    for attempt in range(1, firebot.OUTBOX_MAX_ATTEMPTS + 1):
+        make_due(firebot)
+        assert asyncio.run(firebot.deliver_outbox()) == 1
+
+        (row,) = outbox_rows(firebot)
+        assert row["attempts"] == attempt
+        assert row["last_error"] == "HTTP 500; HTTP 500"
+
+        if attempt < firebot.OUTBOX_MAX_ATTEMPTS:
+            assert row["state"] == "pending"
+
+    assert row["state"] == "failed"
+    make_due(firebot)
+    assert asyncio.run(firebot.deliver_outbox()) == 0
+
+
+def test_backoff_doubles_up_to_cap():
+    """
+    Retries wait 5s, 10s, 20s... up to 15 minutes
+    """
+    import firebot  # pylint: disable=import-outside-toplevel
+
+    assert [firebot.outbox_backoff(attempts) for attempts in (1, 2, 3)] == [5, 10, 20]
+    assert firebot.outbox_backoff(20) == 900
+
+
+@pytest.mark.parametrize(
+    "results, expected",
+    [
+        ({"@main": (101, None), "@backup": (202, None)}, 101),
+        ({"@main": (None, "HTTP 500"), "@backup": (202, None)}, None),
+    ],
+)
+def test_original_message_id_from_main_chat_only(
+    make_firebot, telegram_sends, results, expected
+):
+    """
+    A new-fire alert's message ID is stored for later change notifications to
+    link to, but only the main chat's
+    """
+    firebot = make_firebot(TWO_CHATS)
+    firebot.store.save_incident("ANF", {"id": "ANF-1", "name": "CREEK"})
+    telegram_sends.results = results.get
+    enqueue(firebot, "telegram", "high", "ANF-1")
+    asyncio.run(firebot.deliver_outbox())
+
+    (incident,) = firebot.store.all_incidents("ANF")
+    assert incident.get("original_message_id") == expected
+
+
+def test_sms_only_delivery(make_firebot, sms_sends):
+    """
+    With no Telegram chat configured, a new-fire SMS is delivered and the rest
+    of the outbox still drains
+    """
+    firebot = make_firebot()
+    firebot.store.save_incident("ANF", {"id": "ANF-1", "name": "CREEK"})
+    firebot.store.add_contact(
+        {"number": "+15555550100", "forest": "ANF", "alert_level": "all"}
+    )
+    enqueue(firebot, "sms", "high", "ANF-1")
+    enqueue(firebot, "sms")
+
+    assert firebot.config["telegram_chat_ids"] == []
+    assert asyncio.run(firebot.deliver_outbox()) == 2
+    assert [row["state"] for row in outbox_rows(firebot)] == ["sent", "sent"]
+    assert "original_message_id" not in firebot.store.all_incidents("ANF")[0]
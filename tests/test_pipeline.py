@@ -0,0 +1,110 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./tests/test_pipeline.py
+
+Fingerprint skip and one-transaction commit of process_forest()
+"""
+
+import json
+
+from conftest import wwe_page
+from store import PRIORITIES
+
+# ------------------------------------------------------------------------------
+
+
+def run_traced(firebot, page):
+    """
+    Processes a payload for the current forest. Returns the SQL it ran
+    """
+    statements = []
+    firebot.store.conn.set_trace_callback(statements.append)
+
+    try:
+        firebot.process_forest(page)
+    finally:
+        firebot.store.conn.set_trace_callback(None)
+
+    return statements
+
+
+def writes(statements):
+    """
+    Returns the statements that change rows
+    """
+    return [
+        statement
+        for statement in statements
+        if statement.lstrip().split(" ", 1)[0].upper() in ("INSERT", "UPDATE", "DELETE")
+    ]
+
+
+def outbox_rows(firebot):
+    """
+    Returns every outbox message, oldest first
+    """
+    return [
+        dict(row)
+        for row in firebot.store.conn.execute("SELECT * FROM outbox ORDER BY seq")
+    ]
+
+
+# ------------------------------------------------------------------------------
+
+
+def test_unchanged_payload_writes_nothing(make_firebot, wwe_items):
+    """
+    A payload whose records all match their fingerprints decodes nothing,
+    stores nothing and sends nothing
+    """
+    firebot = make_firebot()
+    page = wwe_page(wwe_items)
+    firebot.process_forest(page)
+    queued = outbox_rows(firebot)
+
+    assert queued  # The first poll alerts on every fire
+
+    statements = run_traced(firebot, page)
+
+    # Only the history's last-seen time moves on
+    assert [statement.split(" SET ")[0] for statement in writes(statements)] == [
+        "UPDATE incident_history"
+    ]
+    assert outbox_rows(firebot) == queued
+    assert firebot.forest["idle_polls"] == 1
+
+
+def test_changed_record_is_one_diff_in_one_transaction(make_firebot, wwe_items):
+    """
+    Changing one record yields one diff alert per channel, committed in a
+    single transaction
+    """
+    firebot = make_firebot()
+    firebot.process_forest(wwe_page(wwe_items))
+    queued = len(outbox_rows(firebot))
+
+    changed = next(item for item in wwe_items if item["name"] == "CREEK")
+    changed["webComment"] = "FORWARD PROGRESS STOPPED"
+    statements = run_traced(firebot, wwe_page(wwe_items))
+
+    begins = [statement for statement in statements if statement.startswith("BEGIN")]
+    assert len(begins) == 1
+
+    messages = outbox_rows(firebot)[queued:]
+    assert sorted(message["channel"] for message in messages) == ["sms", "telegram"]
+    assert all(message["priority"] == PRIORITIES["low"] for message in messages)
+    assert all("FORWARD PROGRESS STOPPED" in message["body"] for message in messages)
+
+    fiscal_data = json.loads(changed["fiscal_data"])
+    revisions = firebot.store.conn.execute(
+        "SELECT id, field, new FROM incident_revisions"
+    ).fetchall()
+    assert [tuple(revision) for revision in revisions] == [
+        (
+            fiscal_data["wfdssunit"] + "-" + fiscal_data["inc_num"],
+            "comment",
+            "FORWARD PROGRESS STOPPED",
+        )
+    ]
@@ -0,0 +1,90 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./tests/test_polling.py
+
+Daemon poll scheduling: per-host fetch budgets
+"""
+
+import time
+
+import pytest
+
+# ------------------------------------------------------------------------------
+
+
+@pytest.fixture
+def three_forests(make_firebot, monkeypatch):
+    """
+    Three WildWeb forests on wildcad.net and one WildWeb-E forest, with fresh
+    per-host budgets
+    """
+    import firebot  # pylint: disable=import-outside-toplevel
+
+    monkeypatch.setattr(firebot, "poll_budgets", {})
+
+    def make(env=None):
+        return make_firebot({"FORESTS": "ANF,LPF,CNF,BDF:caancc", **(env or {})})
+
+    return make
+
+
+def test_default_budget_holds_the_floor_on_a_shared_host(three_forests):
+    """
+    By default every forest on a host can be polled at POLL_FLOOR for good
+    """
+    firebot = three_forests()
+    wildweb = firebot.poll_budget(firebot.forests[0])
+
+    assert wildweb is firebot.poll_budget(firebot.forests[2])
+    assert wildweb.per_second == pytest.approx(3 / firebot.config["poll_floor"])
+    assert firebot.poll_budget(firebot.forests[3]).per_second == pytest.approx(
+        1 / firebot.config["poll_floor"]
+    )
+
+
+def test_budget_scales_with_forests_on_the_host(three_forests):
+    """
+    POLL_MAX_PER_HOUR is per forest, pooled per host, bursting a quarter hour
+    """
+    firebot = three_forests({"POLL_MAX_PER_HOUR": "60"})
+    wildweb = firebot.poll_budget(firebot.forests[0])
+
+    assert wildweb.per_second == pytest.approx(180 / 3600)
+    assert wildweb.capacity == 45
+    assert firebot.poll_budget(firebot.forests[3]).capacity == 15
+
+
+def test_jitter_stays_within_floor_and_ceiling(three_forests, monkeypatch):
+    """
+    Jitter never takes a wait below POLL_FLOOR or above POLL_CEILING
+    """
+    firebot = three_forests({"POLL_JITTER": "0.5"})
+    this_forest = firebot.forests[0]
+
+    for jitter in (-0.5, 0.5):
+        monkeypatch.setattr(firebot.random, "uniform", lambda low, high, j=jitter: j)
+
+        this_forest["last_activity"] = time.time()
+        this_forest["idle_polls"] = 0
+        assert firebot.poll_delay(this_forest) >= firebot.config["poll_floor"]
+
+        this_forest["last_activity"] = 0.0
+        this_forest["idle_polls"] = 20
+        assert firebot.poll_delay(this_forest) <= firebot.config["poll_ceiling"]
+
+
+@pytest.mark.parametrize("env", [{"POLL_FLOOR": "0"}, {"POLL_INTERVAL": "0"}])
+def test_zero_floor_only_stops_the_daemon(make_firebot, monkeypatch, env):
+    """
+    A zero floor doesn't break cron runs, which never use the scheduler, but
+    the daemon refuses to start
+    """
+    firebot = make_firebot(env)
+    monkeypatch.setattr(firebot, "DAEMON", False)  # Set by the daemon option
+
+    assert firebot.config["poll_floor"] == 0
+
+    with pytest.raises(SystemExit):
+        firebot.setup(["firebot.py", "daemon"])
@@ -0,0 +1,43 @@
+"""
+N.F.-FireBot (National Forest FireBot)
+https://github.com/acceptableEngineering/nf-firebot
+
+./tests/test_short_urls.py
+
+Short URL lookups: cron runs never load the whole urls table
+"""
+
+from store import ShortUrls, Store
+
+# ------------------------------------------------------------------------------
+
+
+def test_lookup_without_preload_reads_only_its_url(tmp_path):
+    """
+    Without preload, shortening a URL touches its own row, not the table
+    """
+    store = Store(str(tmp_path / "firebot.sqlite3"))
+    first_id = ShortUrls(store).get_id("https://example.com/1")
+    ShortUrls(store).get_id("https://example.com/2")
+
+    statements = []
+    store.conn.set_trace_callback(statements.append)
+    short_urls = ShortUrls(store)
+
+    assert short_urls.get_id("https://example.com/1") == first_id
+    assert short_urls.get_id("https://example.com/1") == first_id  # Cached
+    assert short_urls.get_id("https://example.com/3") not in (first_id, None)
+    assert not [statement for statement in statements if "rowid >" in statement]
+    assert short_urls.ids.keys() == {"https://example.com/1", "https://example.com/3"}
+
+
+def test_preload_indexes_every_url(tmp_path):
+    """
+    Long-lived processes load the whole index on first use
+    """
+    store = Store(str(tmp_path / "firebot.sqlite3"))
+    first_id = ShortUrls(store).get_id("https://example.com/1")
+    short_urls = ShortUrls(store, preload=True)
+    short_urls.get_id("https://example.com/2")
+
+    assert short_urls.urls[first_id] == "https://example.com/1"